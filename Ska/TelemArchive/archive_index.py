@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+Maintain an index of the telemetry archive day files.
+
+The index is a sqlite database next to db.sql3 with one row per
+SKA_DATA/YYYY/DOY/<table_type>.fits.gz file giving the file time bounds and row
+count.  fetch() uses it to plan
+exactly which day files cover the requested time range before opening any of
+them, so missing days cost nothing instead of a stat probe per day.
+
+The days scanned by each index build are recorded in the coverage table.  Only
+time covered by the scanned days is planned from the index, since a day file that
+is not in the index there really is missing.  Dates outside the coverage fall back
+to walking through the day files.
+"""
+__docformat__ = 'restructuredtext'
+import os
+import sys
+import logging
+
+from Ska.TelemArchive import column_store
+
+SKA = os.getenv('SKA') or '/proj/sot/ska'
+SKA_DATA = SKA + '/data/telem_archive'
+INDEX_FILE = SKA_DATA + '/archive_index.sql3'
+
+logger = logging.getLogger('data_table')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS day_files (
+  table_type text not null,
+  year int not null,
+  doy int not null,
+  path text not null,
+  file_tstart float not null,
+  file_tstop float not null,
+  n_rows int not null,
+  src_mtime float not null,
+  PRIMARY KEY (table_type, year, doy)
+);
+CREATE INDEX IF NOT EXISTS day_files_tstop ON day_files (table_type, file_tstop);
+CREATE TABLE IF NOT EXISTS coverage (
+  table_type text not null,
+  day_start float not null,
+  day_stop float not null,
+  file_tstop float not null
+);
+"""
+
+def main():
+    (opt, args) = get_options()
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    if opt.debug:
+        logger.setLevel(logging.DEBUG)
+
+    n_indexed = build_index(start=opt.start, stop=opt.stop,
+                            table_types=args or None, force=opt.force)
+    print 'Indexed %d day files' % n_indexed
+
+def connect(create=False):
+    """Return a connection to the index or None if there is no index and ``create``
+    is False"""
+    if not create and not os.path.exists(INDEX_FILE):
+        return None
+    import sqlite3 as sqlite
+    conn = sqlite.connect(INDEX_FILE)
+    if create:
+        conn.executescript(SCHEMA)
+    return conn
+
+def build_index(start=None, stop=None, table_types=None, force=False):
+    """Add archive day files to the index that are not yet indexed or have changed
+    since they were indexed.  ``start`` and ``stop`` are inclusive 'YYYY:DOY' strings.
+    Return the number of day files indexed.
+    """
+    from Ska.TelemArchive.data_table import DataTable, add_days, day_start
+
+    conn = connect(create=True)
+    indexed = dict(((x[0], x[1], x[2]), x[3]) for x in
+                   conn.execute('SELECT table_type, year, doy, src_mtime FROM day_files'))
+    n_indexed = 0
+    day_files = column_store.get_day_files(start, stop, table_types)
+    failed = set()
+    for year, doy, table_type in day_files:
+        src_mtime = os.stat(column_store.fits_file(year, doy, table_type)).st_mtime
+        if not force and indexed.get((table_type, year, doy)) == src_mtime:
+            continue
+        try:
+            table = DataTable(year, doy, table_type, [])
+        except Exception, msg:
+            logger.warning('Failed to index %s: %s'
+                           % (column_store.fits_file(year, doy, table_type), msg))
+            failed.add(table_type)
+            continue
+        conn.execute('INSERT OR REPLACE INTO day_files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (table_type, year, doy, '%04d/%03d/%s.fits.gz' % (year, doy, table_type),
+                      float(table.file_tstart), float(table.file_tstop), table.n_rows,
+                      src_mtime))
+        conn.commit()
+        logger.debug('Indexed %s' % table.file_name)
+        n_indexed += 1
+
+    # Record the days scanned for each table type whose files were all indexed
+    for table_type in set(x[2] for x in day_files) - failed:
+        days = [x[:2] for x in day_files if x[2] == table_type]
+        first_day = tuple(int(x) for x in start.split(':')[:2]) if start else days[0]
+        last_day = tuple(int(x) for x in stop.split(':')[:2]) if stop else days[-1]
+        file_tstop = conn.execute(
+            'SELECT max(file_tstop) FROM day_files WHERE table_type=? '
+            'AND year * 1000 + doy BETWEEN ? AND ?',
+            (table_type, first_day[0] * 1000 + first_day[1],
+             last_day[0] * 1000 + last_day[1])).fetchone()[0]
+        if file_tstop is None:
+            continue
+        ranges = merge_coverage(get_coverage_rows(conn, table_type) +
+                                [(day_start(*first_day), day_start(*add_days(*last_day + (1,))),
+                                  file_tstop)])
+        conn.execute('DELETE FROM coverage WHERE table_type=?', (table_type,))
+        conn.executemany('INSERT INTO coverage VALUES (?, ?, ?, ?)',
+                         [(table_type,) + x for x in ranges])
+    conn.commit()
+
+    conn.close()
+    return n_indexed
+
+def get_coverage_rows(conn, table_type):
+    return conn.execute('SELECT day_start, day_stop, file_tstop '
+                        'FROM coverage WHERE table_type=?', (table_type,)).fetchall()
+
+def merge_coverage(rows):
+    """Merge (day_start, day_stop, file_tstop) coverage rows of index builds over
+    adjoining or overlapping days.  Return the merged rows in time order."""
+    ranges = []
+    for row in sorted(tuple(x) for x in rows):
+        if ranges and row[0] <= ranges[-1][1]:
+            last = ranges[-1]
+            ranges[-1] = (last[0], max(last[1], row[1]), max(last[2], row[2]))
+        else:
+            ranges.append(row)
+    return ranges
+
+def get_coverage(conn, table_type, tstart):
+    """Return the (start, stop) time range covered by the index for ``table_type``
+    that is the first to stop after ``tstart``, or None if there is none.  The range
+    starts at the start of the first day scanned, so earlier dates are walked as they
+    would be without the index, and stops at the last file stop time."""
+    for day_start, day_stop, file_tstop in merge_coverage(get_coverage_rows(conn, table_type)):
+        if file_tstop > tstart:
+            return day_start, file_tstop
+    return None
+
+def get_file_plan(table_type, tstart, tstop):
+    """Find the day files of ``table_type`` that overlap [tstart, tstop) (Chandra secs).
+
+    :rtype: files, index_start, index_stop = list of (year, doy, file_tstart,
+            file_tstop) tuples in time order, time range [index_start, index_stop) that
+            the index covers for the table type (see get_coverage()).  Return None,
+            None, None if there is no index or it does not cover the table type after
+            tstart.
+    """
+    conn = connect()
+    if conn is None:
+        return None, None, None
+    coverage = get_coverage(conn, table_type, tstart)
+    if coverage is None:
+        conn.close()
+        return None, None, None
+    index_start, index_stop = coverage
+    files = conn.execute('SELECT year, doy, file_tstart, file_tstop FROM day_files '
+                         'WHERE table_type=? AND file_tstop > ? AND file_tstart < ? '
+                         'ORDER BY file_tstart',
+                         (table_type, max(tstart, index_start), min(tstop, index_stop))).fetchall()
+    conn.close()
+    return files, index_start, index_stop
+
+def get_options():
+    from optparse import OptionParser
+    parser = OptionParser(usage='archive_index.py [options] [table_type1 ...]')
+    parser.set_defaults()
+    parser.add_option("--start",
+                      help="First day to index (YYYY:DOY, default = first in archive)",
+                      )
+    parser.add_option("--stop",
+                      help="Last day to index (YYYY:DOY, default = last in archive)",
+                      )
+    parser.add_option("--force",
+                      action="store_true",
+                      default=False,
+                      help="Index day files even if they are already up to date",
+                      )
+    parser.add_option("--debug",
+                      action="store_true",
+                      default=False,
+                      help="Enable debug output",
+                      )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Maintain a pre-decompressed columnar mirror of the telemetry archive FITS files.
+
+Each SKA_DATA/YYYY/DOY/<table_type>.fits.gz file is stored as a directory
+SKA_DATA/columns/YYYY/DOY/<table_type>/ containing one uncompressed numpy ``.npy``
+file per column plus a small ``header.pkl`` with the row count and time bounds.
+The column files are memory-mapped on read so repeated fetches of the same days
+cost page-cache hits instead of gunzip plus FITS parsing.
+"""
+__docformat__ = 'restructuredtext'
+import os
+import sys
+import re
+import shutil
+import logging
+import cPickle
+import numpy
+
+SKA = os.getenv('SKA') or '/proj/sot/ska'
+SKA_DATA = SKA + '/data/telem_archive'
+STORE_ROOT = SKA_DATA + '/columns'
+
+logger = logging.getLogger('data_table')
+
+def main():
+    (opt, args) = get_options()
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    if opt.debug:
+        logger.setLevel(logging.DEBUG)
+
+    n_converted = update_store(start=opt.start, stop=opt.stop,
+                               table_types=args or None, force=opt.force)
+    print 'Converted %d day files' % n_converted
+
+def store_dir(year, doy, table_type):
+    return STORE_ROOT + '/%04d/%03d/%s' % (year, doy, table_type)
+
+def fits_file(year, doy, table_type):
+    return SKA_DATA + '/%04d/%03d/%s.fits.gz' % (year, doy, table_type)
+
+def read_header(year, doy, table_type):
+    """Return the header dict for the stored day table or None if it is not in the store"""
+    try:
+        return cPickle.load(open(os.path.join(store_dir(year, doy, table_type), 'header.pkl'), 'rb'))
+    except (IOError, EOFError):
+        return None
+
+def read_columns(year, doy, table_type, col_names):
+    """Memory-map ``col_names`` for the stored day table.  Return a dict of read-only
+    arrays by column name.  String columns are viewed as chararray to match pyfits.
+    """
+    outdir = store_dir(year, doy, table_type)
+    columns = {}
+    for col_name in col_names:
+        arr = numpy.load(os.path.join(outdir, col_name + '.npy'), mmap_mode='r')
+        if arr.dtype.kind == 'S':
+            arr = arr.view(numpy.chararray)
+        columns[col_name] = arr
+    return columns
+
+def write_columns(outdir, columns, header):
+    """Write dict of ``columns`` arrays and ``header`` dict as a store directory.
+    The directory is assembled under a temporary name and renamed into place so
+    readers never see a partial table.
+    """
+    tmpdir = '%s.tmp%d' % (outdir, os.getpid())
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    for col_name, arr in columns.items():
+        numpy.save(os.path.join(tmpdir, col_name + '.npy'), numpy.asarray(arr))
+    cPickle.dump(header, open(os.path.join(tmpdir, 'header.pkl'), 'wb'), -1)
+
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    os.rename(tmpdir, outdir)
+
+def convert_day(year, doy, table_type):
+    """Convert one FITS day file into the store"""
+    import pyfits
+    from Ska.TelemArchive.data_table import native_array
+
+    filename = fits_file(year, doy, table_type)
+    logger.debug('Converting file %s' % filename)
+    src_mtime = os.stat(filename).st_mtime
+    hdulist = pyfits.open(filename)
+    bintbl = hdulist[1]
+    columns = dict((x, native_array(bintbl.data.field(x))) for x in bintbl.columns.names)
+    hdulist.close()
+
+    header = dict(n_rows=len(columns['tstart']),
+                  file_tstart=float(columns['tstart'][0]),
+                  file_tstop=float(columns['tstop'][-1]),
+                  col_names=list(bintbl.columns.names),
+                  src_mtime=src_mtime)
+    write_columns(store_dir(year, doy, table_type), columns, header)
+
+def get_day_files(start=None, stop=None, table_types=None):
+    """Find archive FITS day files.  ``start`` and ``stop`` are inclusive 'YYYY:DOY'
+    strings.  Return list of (year, doy, table_type) tuples in time order.
+    """
+    start = tuple(int(x) for x in start.split(':')[:2]) if start else (0, 0)
+    stop = tuple(int(x) for x in stop.split(':')[:2]) if stop else (9999, 999)
+    day_files = []
+    for year in sorted(x for x in os.listdir(SKA_DATA) if re.match(r'\d{4}$', x)):
+        yeardir = os.path.join(SKA_DATA, year)
+        for doy in sorted(x for x in os.listdir(yeardir) if re.match(r'\d{3}$', x)):
+            if not start <= (int(year), int(doy)) <= stop:
+                continue
+            for filename in sorted(os.listdir(os.path.join(yeardir, doy))):
+                match = re.match(r'(.+)\.fits\.gz$', filename)
+                if match and (table_types is None or match.group(1) in table_types):
+                    day_files.append((int(year), int(doy), match.group(1)))
+    return day_files
+
+def update_store(start=None, stop=None, table_types=None, force=False):
+    """Convert archive day files that are not yet in the store or have changed since
+    they were converted.  Return the number of day files converted.
+    """
+    n_converted = 0
+    for year, doy, table_type in get_day_files(start, stop, table_types):
+        if not force:
+            header = read_header(year, doy, table_type)
+            if (header is not None and
+                header['src_mtime'] == os.stat(fits_file(year, doy, table_type)).st_mtime):
+                continue
+        try:
+            convert_day(year, doy, table_type)
+            n_converted += 1
+        except Exception, msg:
+            logger.warning('Failed to convert %s: %s'
+                           % (fits_file(year, doy, table_type), msg))
+    return n_converted
+
+def get_options():
+    from optparse import OptionParser
+    parser = OptionParser(usage='column_store.py [options] [table_type1 ...]')
+    parser.set_defaults()
+    parser.add_option("--start",
+                      help="First day to convert (YYYY:DOY, default = first in archive)",
+                      )
+    parser.add_option("--stop",
+                      help="Last day to convert (YYYY:DOY, default = last in archive)",
+                      )
+    parser.add_option("--force",
+                      action="store_true",
+                      default=False,
+                      help="Convert day files even if they are already up to date",
+                      )
+    parser.add_option("--debug",
+                      action="store_true",
+                      default=False,
+                      help="Enable debug output",
+                      )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
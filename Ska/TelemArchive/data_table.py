@@ -3,10 +3,16 @@ import sys
 import re
 import pprint
 import logging
+import threading
+import datetime
+from collections import OrderedDict
 
-import pyfits
-from mx.DateTime import strptime, DateTime, Error, DateTimeDeltaFromSeconds
-import Chandra.Time
+import numpy
+
+from Ska.TelemArchive import column_store
+from Ska.TelemArchive import archive_index
+from Ska.TelemArchive.shm_cache import shm_cache
+from Ska.TelemArchive.fetch_stats import stats
 
 SKA = os.getenv('SKA') or '/proj/sot/ska'
 SKA_DATA = SKA + '/data/telem_archive'
@@ -18,13 +24,38 @@ class NullHandler(logging.Handler):
 logger = logging.getLogger('data_table')
 logger.addHandler(NullHandler())
 
-data_tables = {}                        # Currently active data tables
 files_not_found = set()
+fits_open_lock = threading.Lock()       # pyfits.open() is not thread-safe
+
+def get_src_mtime(file_name):
+    """Return the modification time of day file ``file_name`` or None if it is missing"""
+    try:
+        return os.stat(file_name).st_mtime
+    except OSError:
+        return None
 
 def add_days(year, doy, delta_days):
-    d0 = Chandra.Time.DateTime('%04d:%03d' % (year,doy)).mxDateTime
-    d1 = d0 + delta_days
-    return d1.year, d1.day_of_year
+    d1 = datetime.date(year, 1, 1) + datetime.timedelta(days=doy - 1 + delta_days)
+    return d1.year, d1.timetuple().tm_yday
+
+def date_to_day(date):
+    """Return (year, doy) of the day containing ``date`` (Chandra secs)"""
+    import Chandra.Time
+    date = Chandra.Time.DateTime(date).date
+    return int(date[0:4]), int(date[5:8])
+
+def day_start(year, doy):
+    """Return Chandra secs at the start of day ``year``:``doy``"""
+    import Chandra.Time
+    return Chandra.Time.DateTime('%04d:%03d:00:00:00.000' % (year, doy)).secs
+
+def native_array(col):
+    """Return a contiguous copy of FITS column ``col`` in native byte order.  String
+    columns keep the chararray behavior of stripping trailing blanks."""
+    arr = numpy.ascontiguousarray(col, dtype=col.dtype.newbyteorder('='))
+    if arr.dtype.kind == 'S':
+        arr = arr.view(numpy.chararray)
+    return arr
 
 class BeforeTableStart(RuntimeError):
     pass
@@ -40,42 +71,135 @@ class DataTable(object):
     Provide methods to read an archive FITS data table and return column
     values corresponding to a particular time.
     """
-    def __init__(self, year, doy, table_type):
+    def __init__(self, year, doy, table_type, col_names=None):
         self.file_name = SKA_DATA + '/%04d/%03d/%s.fits.gz' % (year, doy, table_type)
         self.doy = doy
         self.year = year
         self.table_type = table_type
+        self.i_row = 0
+        self.col_names = []
+        self.fits_data_arr = {}
+        self.src_mtime = get_src_mtime(self.file_name)
+
+        # Read the requested columns (default all) along with the time bins and quality
+        self.read_columns(col_names)
+
+        # Row time bins as arrays for vectorized lookups in get_rows()
+        self.row_tstart = self.fits_data_arr['tstart']
+        self.row_tstop = self.fits_data_arr['tstop']
+
+        # Start and stop date for file (as Chandra seconds)
+        self.file_tstart = self.row_tstart[0]
+        self.file_tstop = self.row_tstop[-1]
+        # Start and stop date for first record (as Chandra seconds)
+        self.tstart = self.row_tstart[0]
+        self.tstop = self.row_tstop[0]
+
+    def read_columns(self, col_names=None):
+        """Read ``col_names`` (default all columns) into memory.  Use the
+        pre-decompressed column store if the day table has been converted since the
+        FITS file last changed, otherwise the shared table cache (if enabled) or the
+        FITS file.  Columns that are already in memory are not read again.
+        """
+        header = column_store.read_header(self.year, self.doy, self.table_type)
+        if header is not None:
+            if header['src_mtime'] != get_src_mtime(self.file_name):
+                # Day file changed since it was converted to the store
+                logger.debug('Column store for %s is out of date' % self.file_name)
+                header = None
+        if header is not None:
+            self.read_store_columns(header, col_names)
+        elif shm_cache.enabled:
+            self.read_shm_columns(col_names)
+        else:
+            self.read_fits_columns(col_names)
+
+    def read_store_columns(self, header, col_names=None):
+        """Memory-map ``col_names`` from the column store (zero-copy)"""
+        logger.debug('Reading column store for %s' % self.file_name)
+        self.n_rows = header['n_rows']
+        self.all_col_names = header['col_names']
+        if col_names is None:
+            col_names = header['col_names']
+        col_names = [x for x in ['tstart', 'tstop', 'quality'] + list(col_names)
+                     if x not in self.fits_data_arr]
+        with stats.timer('store_read'):
+            self.fits_data_arr.update(column_store.read_columns(self.year, self.doy,
+                                                                self.table_type, col_names))
+        stats.count('store_columns_read', len(col_names))
+        self.col_names.extend(col_names)
+
+    def read_shm_columns(self, col_names=None):
+        """Attach ``col_names`` from the shared table cache.  Columns that are not in
+        the cache yet are read from the FITS file and published for other processes."""
+        header = shm_cache.attach(self.year, self.doy, self.table_type)
+        if header is not None:
+            logger.debug('Attaching shared table cache for %s' % self.file_name)
+            self.n_rows = header['n_rows']
+            self.all_col_names = header['col_names']
+            names = [x for x in ['tstart', 'tstop', 'quality'] + list(col_names or self.all_col_names)
+                     if x not in self.fits_data_arr]
+            columns = shm_cache.read_columns(self.year, self.doy, self.table_type, names)
+            self.fits_data_arr.update(columns)
+            self.col_names.extend(x for x in names if x in columns)
+            if len(columns) == len(names):
+                return
+
+        n_cols = len(self.col_names)
+        self.read_fits_columns(col_names)
+        new_names = self.col_names[n_cols:]
+        header = dict(n_rows=self.n_rows,
+                      col_names=list(self.all_col_names),
+                      src_mtime=os.stat(self.file_name).st_mtime)
+        columns = dict((x, self.fits_data_arr[x]) for x in new_names)
+        self.fits_data_arr.update(shm_cache.publish(self.year, self.doy, self.table_type,
+                                                    header, columns))
+
+    def read_fits_columns(self, col_names=None):
+        """Read ``col_names`` from the FITS file.  Columns are stored as native byte
+        order arrays so the decompressed FITS data buffer (including any columns that
+        were not requested) is released when the file is closed.
+        """
+        import pyfits
 
         # Don't try to read if it already failed
         if self.file_name in files_not_found:
             raise IOError
         logger.debug('Reading file %s' % self.file_name)
         try:
-            hdulist = pyfits.open(self.file_name)
+            with stats.timer('gunzip'):
+                with fits_open_lock:
+                    hdulist = pyfits.open(self.file_name)
+                bintbl = hdulist[1]   # First extension of HDU list
+                data = bintbl.data
         except IOError:
             logger.debug('Could not open %s, raising IOError' % self.file_name)
             files_not_found.add(self.file_name)
             raise
-        bintbl = hdulist[1]   # First extension of HDU list
-        self.col_names = bintbl.columns.names
-        self.i_row = 0
         self.n_rows = bintbl.header['naxis2']
-        self.references = 1
-
-        # Read the entire table into memory as a dict of lists for efficiency
-        self.fits_data_arr = {}
-        for col_name in self.col_names:
-            col = bintbl.data.field(col_name)
-            self.fits_data_arr[col_name] = list(col)
+        self.all_col_names = bintbl.columns.names
+        stats.count('files_opened')
+        stats.count('bytes_decompressed', self.n_rows * bintbl.header['naxis1'])
 
-        # Start and stop date for file (as Chandra seconds)
-        self.file_tstart = self.fits_data_arr['tstart'][0]
-        self.file_tstop = self.fits_data_arr['tstop'][-1]
-        # Start and stop date for first record (as Chandra seconds)
-        self.tstart = self.fits_data_arr['tstart'][0]
-        self.tstop = self.fits_data_arr['tstop'][0]
+        if col_names is None:
+            col_names = bintbl.columns.names
+        with stats.timer('fits_decode'):
+            for col_name in ['tstart', 'tstop', 'quality'] + list(col_names):
+                if col_name not in self.fits_data_arr:
+                    self.fits_data_arr[col_name] = native_array(data.field(col_name))
+                    self.col_names.append(col_name)
         hdulist.close()
 
+    def has_columns(self, col_names=None):
+        if col_names is None:
+            col_names = self.all_col_names
+        return all(x in self.fits_data_arr for x in col_names)
+
+    def _nbytes(self):
+        return sum(x.nbytes for x in self.fits_data_arr.values())
+
+    nbytes = property(_nbytes)
+
     def reset(self):
         self.i_row = 0
 
@@ -116,6 +240,24 @@ class DataTable(object):
         
         return fda[column_name][self.i_row], fda['quality'][self.i_row]
 
+    def get_rows(self, dates):
+        """Vectorized version of get_value() that finds the bin containing each of
+        ``dates`` (array of Chandra secs) with a binary search over the row bins.
+
+        :rtype: i_rows, ok = row index array, bool array (False for dates in a data gap
+                or outside the table)
+        """
+        # Same 1 msec slop at the bin edges as get_value()
+        i_rows = numpy.searchsorted(self.row_tstart, dates + 0.001, side='right') - 1
+        i_rows = i_rows.clip(0, self.n_rows - 1)
+        ok = ((dates > self.row_tstart[i_rows] - 0.001) & (dates < self.row_tstop[i_rows])
+              & (dates >= self.file_tstart) & (dates < self.file_tstop))
+        return i_rows, ok
+
+    def take(self, column_name, i_rows):
+        """Return array of ``column_name`` values at row indices ``i_rows``"""
+        return self.fits_data_arr[column_name][i_rows]
+
 class DataColumn(object):
     """
     Access data from a column name from a table type.  The class manages the associated
@@ -130,31 +272,14 @@ class DataColumn(object):
     def drop_table(self):
         if not self.data_table:
             return
-        logger.debug('Dropping ref #%d to table %s' % 
-                      (self.data_table.references, self.data_table.file_name))
-        self.data_table.references -= 1
-        if self.data_table.references <= 0:
-            logger.debug('Dropping table %s' % self.data_table.file_name)
-            del data_tables[self.data_table.file_name]
+        logger.debug('Dropping table %s' % self.data_table.file_name)
         self.data_table = None
 
     def register_table(self, year, doy):
         """Register a reference to the DataTable object that contains this column.
-        Create the DataTable object (which connects to the correct FITS data file)
-        if needed."""
-
-        # Check if the DataTable object for this date and table type already exists
-        for x in data_tables.values():
-            if (year, doy, self.table_type) == (x.year, x.doy, x.table_type):
-                self.data_table = x
-                self.data_table.references += 1
-                logger.debug('Adding ref #%d to table file %s' %
-                              (self.data_table.references, self.data_table.file_name))
-                break
-        else:  # Doesn't exist, so create it and add to data_tables registry
-            self.data_table = DataTable(year, doy, self.table_type)
-            data_tables[self.data_table.file_name] = self.data_table
-            logger.debug('Registering new table file %s' % self.data_table.file_name)
+        The DataTable object (which connects to the correct FITS data file) comes
+        from the process-wide table_cache."""
+        self.data_table = table_cache.get(year, doy, self.table_type, [self.name])
 
     def get_value(self, date):
         """Return value for the column for a particular date.  Register a new data_table
@@ -186,6 +311,7 @@ class DataColumn(object):
             #     logger.debug('Got BeforeTableStart')
             #     (year, doy) = add_days(sdt.year, sdt.doy, -1)
         else:
+            import Chandra.Time
             mxdate = Chandra.Time.DateTime(date).mxDateTime
             (year, doy) = (mxdate.year, mxdate.day_of_year)
             logger.debug('Setting year, doy to %d %d' % (year, doy))
@@ -202,3 +328,326 @@ class DataColumn(object):
     def __repr__(self):
         return pprint.pformat(self.__dict__)
 
+class DataColumnGroup(object):
+    """
+    Access data for all requested columns of one table type at arrays of dates.  This
+    is the batch counterpart of DataColumn.get_value(): each day file is opened once and
+    every date falling within it is resolved to a row with a binary search.  Day files
+    are taken from the archive index plan when available (see plan_files()), otherwise
+    the current day file is retained between calls so successive date chunks can be
+    passed in time order.
+    """
+    def __init__(self, table_type, columns):
+        self.table_type = table_type
+        self.columns = columns
+        self.names = [x.name for x in columns]
+        self.data_table = None
+        self.year = None
+        self.doy = None
+        self.file_plan = None
+        self.index_start = None
+        self.index_stop = None
+        self.prefetcher = None
+        self.start_day_set = False
+
+    def plan_files(self, tstart, tstop):
+        """Use the archive index to find the day files that cover [tstart, tstop).  Dates
+        outside the time covered by the index fall back to walking through the day
+        files."""
+        self.file_plan, self.index_start, self.index_stop = archive_index.get_file_plan(
+            self.table_type, tstart, tstop)
+        if self.file_plan is not None:
+            self.plan_tstop = numpy.array([x[3] for x in self.file_plan], dtype=numpy.float64)
+
+    def indexed(self, date):
+        """Return True if ``date`` is planned from the archive index"""
+        return self.file_plan is not None and self.index_start <= date < self.index_stop
+
+    def set_start_day(self, year, doy):
+        """Start the day file walk at year:doy as if the dates before the first
+        requested date had already been processed.  If the year:doy file is missing
+        then the walk starts from the day of the first date, which is where it would be
+        after a run of dates in a missing file."""
+        self.year, self.doy = year, doy
+        self.data_table = None
+        self.start_day_set = True
+
+    def get_values(self, dates, mind_the_gaps=False):
+        """Get values of each column at ``dates`` (sorted array of Chandra secs).
+
+        Missing day files and data gaps are flagged as bad instead of raising an
+        exception unless ``mind_the_gaps`` is set.  The day file walk follows
+        DataColumn.get_value(): continue to the next day after the file stop time and
+        start from the day of the date itself after a missing file.
+
+        :rtype: values, quality, bad = dict of arrays by column name, int quality array
+                (1 for bad), bool array
+        """
+        n_dates = len(dates)
+        bad = numpy.zeros(n_dates, dtype=bool)
+        quality = numpy.zeros(n_dates, dtype=int)
+        values = {}
+
+        with stats.timer('lookup'):
+            i = 0
+            if self.file_plan is not None:
+                # Walk up to the start of the index coverage then plan up to its end
+                i = numpy.searchsorted(dates, self.index_start)
+                self._get_walked_values(dates, 0, values, quality, bad, mind_the_gaps, i)
+                i = self._get_planned_values(dates, i, values, quality, bad, mind_the_gaps)
+            self._get_walked_values(dates, i, values, quality, bad, mind_the_gaps)
+        stats.count('rows_scanned', n_dates)
+
+        for name in self.names:
+            if name not in values:
+                values[name] = numpy.zeros(n_dates)
+            elif values[name].dtype.kind == 'S':
+                values[name] = values[name].view(numpy.chararray)
+        quality[bad] = 1
+
+        return values, quality, bad
+
+    def _get_planned_values(self, dates, i, values, quality, bad, mind_the_gaps):
+        """Get values for dates[i:] covered by the archive index.  Each date belongs to
+        the first planned file that stops after it.  Return the number of dates done."""
+        n_planned = max(numpy.searchsorted(dates, self.index_stop), i)
+        if n_planned > i:
+            # Walk after the end of the index starts from the day of the date
+            self.drop_table()
+            self.start_day_set = False
+        i_files = numpy.searchsorted(self.plan_tstop, dates[:n_planned], side='right')
+        while i < n_planned:
+            i_file = i_files[i]
+            j = i + numpy.searchsorted(i_files[i:n_planned], i_file, side='right')
+            try:
+                if i_file == len(self.file_plan):
+                    raise IOError('No %s archive file at date %s' % (self.table_type, dates[i]))
+                year, doy = self.file_plan[i_file][:2]
+                for next_file in self.file_plan[i_file + 1:]:
+                    if not self._prefetch(*next_file[:2]):
+                        break
+                sdt = self._get_table(year, doy)
+            except IOError:
+                if mind_the_gaps:
+                    raise
+                bad[i:j] = True
+            else:
+                self._fill(sdt, dates, i, j, values, quality, bad, mind_the_gaps)
+            i = j
+        return n_planned
+
+    def _get_walked_values(self, dates, i, values, quality, bad, mind_the_gaps,
+                           n_dates=None):
+        """Get values for dates[i:n_dates] by walking through the day files"""
+        if n_dates is None:
+            n_dates = len(dates)
+        while i < n_dates:
+            if self.data_table is None:
+                day_from_date = self.year is None
+                if day_from_date:
+                    self.year, self.doy = date_to_day(dates[i])
+                for delta_days in range(1, self.prefetcher.depth + 1 if self.prefetcher else 1):
+                    self._prefetch(*add_days(self.year, self.doy, delta_days))
+                start_day_set, self.start_day_set = self.start_day_set, False
+                try:
+                    self.data_table = self._get_table(self.year, self.doy)
+                except IOError:
+                    if start_day_set:
+                        self.year = self.doy = None
+                        continue
+                    if mind_the_gaps:
+                        raise
+                    # If the day came from the date then every date until the end of
+                    # that day is in the missing file.  Otherwise just this date.
+                    if day_from_date:
+                        j = i + numpy.searchsorted(dates[i:n_dates], day_start(*add_days(self.year, self.doy, +1)))
+                    else:
+                        j = i + 1
+                    bad[i:j] = True
+                    i = j
+                    self.year = self.doy = None
+                    continue
+
+            sdt = self.data_table
+            j = i + numpy.searchsorted(dates[i:n_dates], sdt.file_tstop)
+            if j > i:
+                self._fill(sdt, dates, i, j, values, quality, bad, mind_the_gaps)
+                i = j
+
+            if i < n_dates:
+                # Remaining dates are after the end of this file so move to the next day
+                self.year, self.doy = add_days(sdt.year, sdt.doy, +1)
+                self.data_table = None
+
+    def _get_table(self, year, doy):
+        if self.prefetcher:
+            return self.prefetcher.get(year, doy, self.table_type, self.names)
+        return table_cache.get(year, doy, self.table_type, self.names)
+
+    def _prefetch(self, year, doy):
+        """Start reading a day table ahead of time.  Return False once the read-ahead
+        depth is reached."""
+        if self.prefetcher:
+            return self.prefetcher.prefetch(year, doy, self.table_type, self.names)
+        return False
+
+    def _fill(self, sdt, dates, i, j, values, quality, bad, mind_the_gaps):
+        """Fill values, quality and bad for dates[i:j] from DataTable ``sdt``"""
+        i_rows, ok = sdt.get_rows(dates[i:j])
+        if mind_the_gaps and not ok.all():
+            raise DateNotInTable('Data gap: date %s not in table %s'
+                                 % (dates[i + numpy.flatnonzero(~ok)[0]], sdt.file_name))
+        for name in self.names:
+            vals = sdt.take(name, i_rows)
+            if name not in values:
+                values[name] = numpy.zeros(len(dates), dtype=vals.dtype)
+            values[name][i:j] = vals
+        row_quality = sdt.take('quality', i_rows)
+        if row_quality.dtype.kind == 'f':
+            row_quality = numpy.where(numpy.isnan(row_quality), 0, row_quality)
+        quality[i:j] = row_quality.astype(int)
+        bad[i:j] = ~ok
+
+    def drop_table(self):
+        self.data_table = None
+        self.year = self.doy = None
+
+class TableCache(object):
+    """
+    Process-wide cache of DataTable objects keyed by (year, doy, table_type) so that
+    repeated fetches over the same days do not read the day files again.  Tables are
+    evicted in least recently used order once the total size of the column arrays
+    exceeds max_bytes.  A cached table is read again if its day file has changed
+    since.  Missing day files are remembered separately in files_not_found.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.tables = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, year, doy, table_type, col_names=None):
+        """Return DataTable for year, doy and table_type with at least ``col_names``
+        (default all columns) in memory.  Raise IOError if the day file is missing."""
+        key = (year, doy, table_type)
+        with self.lock:
+            table = self.tables.pop(key, None)
+            if table is not None and table.src_mtime != get_src_mtime(table.file_name):
+                # Day file changed since the table was read
+                logger.debug('Table cache dropped out of date %s' % table.file_name)
+                self.nbytes -= table.nbytes
+                shm_cache.release(*key)
+                table = None
+            if table is not None:
+                self.tables[key] = table   # Move to most recently used
+                if not table.has_columns(col_names):
+                    # Cached table is missing some columns so read those in
+                    self.nbytes -= table.nbytes
+                    table.read_columns(col_names)
+                    self.nbytes += table.nbytes
+                self.hits += 1
+                stats.count('cache_hits')
+                logger.debug('Table cache hit for %s' % table.file_name)
+                return table
+
+        table = DataTable(year, doy, table_type, col_names)
+        with self.lock:
+            self.misses += 1
+            stats.count('cache_misses')
+            if key in self.tables:
+                # Another thread read the same table in the meantime
+                self.nbytes -= self.tables[key].nbytes
+            self.tables[key] = table
+            self.nbytes += table.nbytes
+            self._evict()
+        return table
+
+    def _evict(self):
+        # Always keep the most recently used table even if it alone exceeds max_bytes
+        while self.nbytes > self.max_bytes and len(self.tables) > 1:
+            key, table = self.tables.popitem(last=False)
+            self.nbytes -= table.nbytes
+            shm_cache.release(*key)
+            self.evictions += 1
+            logger.debug('Table cache evicted %s' % table.file_name)
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """Drop all cached tables and forget missing day files"""
+        with self.lock:
+            self.tables.clear()
+            self.nbytes = 0
+            files_not_found.clear()
+            shm_cache.release_all()
+
+    def stats(self):
+        with self.lock:
+            return dict(n_tables=len(self.tables), nbytes=self.nbytes, max_bytes=self.max_bytes,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+table_cache = TableCache(max_bytes=int(os.getenv('TELEM_ARCHIVE_CACHE_MB') or 512) * 1024**2)
+
+class TablePrefetcher(object):
+    """
+    Read upcoming day tables into table_cache on a background thread pool while the
+    current day is being sampled, so that day file reads overlap with the lookup and
+    output work.  Up to ``depth`` tables per table type are read ahead.
+    """
+    def __init__(self, depth, n_threads):
+        from multiprocessing.pool import ThreadPool
+        self.depth = depth
+        self.pool = ThreadPool(n_threads)
+        self.pending = OrderedDict()
+
+    def prefetch(self, year, doy, table_type, col_names):
+        """Start reading a table unless it is already cached, pending or known to be
+        missing.  Return False if ``depth`` reads of table_type are already pending."""
+        key = (year, doy, table_type)
+        if key in self.pending or key in table_cache.tables:
+            return True
+        if len([x for x in self.pending if x[2] == table_type]) >= self.depth:
+            return False
+        file_name = column_store.fits_file(year, doy, table_type)
+        if file_name not in files_not_found:
+            logger.debug('Prefetching table %s' % file_name)
+            self.pending[key] = self.pool.apply_async(table_cache.get,
+                                                      (year, doy, table_type, col_names))
+        return True
+
+    def get(self, year, doy, table_type, col_names):
+        """Return table, waiting for a pending read if needed"""
+        result = self.pending.pop((year, doy, table_type), None)
+        if result is not None:
+            with stats.timer('prefetch_wait'):
+                table = result.get()   # Re-raises IOError for a missing file
+            if table.has_columns(col_names):
+                return table
+        return table_cache.get(year, doy, table_type, col_names)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.pending.clear()
+
+def get_column_groups(columns):
+    """Return list of DataColumnGroup objects for the non-pseudo ``columns``, one per
+    table type in order of first appearance"""
+    groups = []
+    by_table = {}
+    for column in columns:
+        if column.table_type == 'pseudo_column':
+            continue
+        if column.table_type not in by_table:
+            by_table[column.table_type] = DataColumnGroup(column.table_type, [])
+            groups.append(by_table[column.table_type])
+        by_table[column.table_type].columns.append(column)
+        by_table[column.table_type].names.append(column.name)
+    return groups
+
@@ -5,22 +5,24 @@ Fetch values from the SKA telemetry archive.
 __docformat__ = 'restructuredtext'
 import os
 import sys
-import re
 import time
 import logging
-import sqlite3 as sqlite
+import cPickle
 import numpy
 
-from Ska.TelemArchive.data_table import DataColumn, DateNotInTable
-import Chandra.Time
-from mx.DateTime import strptime, DateTime, Error, DateTimeDeltaFromSeconds
-import cPickle
-from pyparsing import (Word, alphanums, delimitedList, ParseException,
-                       Optional, lineStart, lineEnd)
+from Ska.TelemArchive.data_table import (DataColumn, DateNotInTable, TablePrefetcher,
+                                         get_column_groups, add_days, date_to_day, day_start,
+                                         files_not_found)
+from Ska.TelemArchive.output import get_writer, read_output, unique_names
+from Ska.TelemArchive.time_convert import convert_times, parse_time, time_precision
+from Ska.TelemArchive.table_catalog import get_catalog, InvalidTableOrColumn
+from Ska.TelemArchive.fetch_stats import stats
 
 SKA = os.getenv('SKA') or '/proj/sot/ska'
 SKA_DATA = SKA + '/data/telem_archive'
 
+logger = logging.getLogger('data_table')
+
 def main():
     (opt, args) = get_options()
     kwargs = opt.__dict__
@@ -37,6 +39,9 @@ def main():
     
     fetch(colspecs=args, **kwargs)
 
+    if opt.profile:
+        print >>sys.stderr, stats.summary()
+
 def fetch(obsid=None,
           outfile=None,
           statusfile=None,
@@ -50,7 +55,14 @@ def fetch(obsid=None,
           dt=32.8,
           out_format=None,
           time_format='secs',
-          colspecs=['ephin2eng:']):
+          colspecs=['ephin2eng:'],
+          prefetch=0,
+          workers=1,
+          profile=False,
+          status_callback=None,
+          checkpointfile=None,
+          resume=False,
+          append=False):
     """
     Fetch data from the telemetry archive.
 
@@ -64,88 +76,520 @@ def fetch(obsid=None,
     :param start: Start date of processing
     :param stop: Stop date of processing
     :param dt: Sampling interval (sec)
-    :param out_format: Format for output ('csv', 'space', 'dmascii', 'tab') (default=None => list)
+    :param out_format: Format for output ('csv', 'space', 'dmascii', 'tab', 'rdb', 'fits',
+                       'npz', 'hdf5') (default=None => list)
     :param time_format: Format for output time stamp
     :param colspecs: List of column specifiers
+    :param prefetch: Number of day files per table type to read ahead in background threads
+    :param workers: Number of processes for fetching day-aligned time shards in parallel
+    :param profile: Record stage timers and counters in fetch_stats.stats (and the statusfile)
+    :param status_callback: Function called with the status dict whenever the status is written
+    :param checkpointfile: Checkpoint file written along with the status to allow resuming
+                           output to outfile (default = <statusfile>.checkpoint)
+    :param resume: Continue the output from the last checkpoint (if any)
+    :param append: Append rows after the last time stamp of an existing outfile
 
     :rtype: headers, values = tuple, list of tuples
     """
-    table_defs = get_table_defs(SKA_DATA + '/tables')
+    if profile:
+        stats.enable()
+    else:
+        stats.disable()
+    # Look again for day files that an earlier fetch in this process found missing
+    files_not_found.clear()
+
+    run = FetchRun(obsid=obsid, outfile=outfile, statusfile=statusfile,
+                   status_interval=status_interval, max_size=max_size,
+                   ignore_quality=ignore_quality, mind_the_gaps=mind_the_gaps,
+                   debug=debug, start=start, stop=stop, dt=dt, out_format=out_format,
+                   time_format=time_format, colspecs=colspecs, prefetch=prefetch,
+                   workers=workers, status_callback=status_callback,
+                   checkpointfile=checkpointfile, resume=resume, append=append)
+    while run.step():
+        pass
+
+    return run.headers, run.values
+
+class FetchRun(object):
+    """
+    One fetch, output a chunk of rows at a time by step().  Parameters are the same
+    as for fetch() except ``profile``.  ``date`` is the start of the last chunk of
+    the date grid that was processed (Chandra secs).
 
-    # Redirect stdout and stderr if specified
-    if outfile:
-        sys_stdout = sys.stdout
-        f_outfile = open(outfile, 'w')
-        sys.stdout = f_outfile
+    A checkpoint is written each time the status is, recording the date grid
+    progress, the day file walk of each table type and the output writer state.
+    Checkpoints are only written for a single process fetch to an output file.
 
-    # Create data column objects for each requested column name (along with date and quality)
-    column_defs = [{'table':'pseudo_column', 'name':'date'}]
-    column_defs.extend(get_column_defs(table_defs, colspecs))
-    if ignore_quality:
-        column_defs.append({'table':'pseudo_column', 'name':'quality'})
-
-    columns = [ DataColumn(x) for x in column_defs]
-    output_headers = write_output(columns, out_format, 'name')
-    output_values = []
-    
-    dates, datestart, datestop, n_dates = get_date_stamps(start, stop, dt, obsid)
-    status = FetchStatus(datestart, datestop, n_dates, columns,
-                         statusfile=statusfile,
-                         status_interval=status_interval,
-                         outfile=outfile,
-                         max_size=max_size)
-    status.write_statusfile()
-
-    for i_date, date in enumerate(dates()):
-        quality = 0
-        for column in columns:
-            if column.table_type == 'pseudo_column':
-                if column.name == 'date':
-                    if time_format == 'secs':
-                        column.value = date
-                    else:
-                        column.value = getattr(Chandra.Time.DateTime(date), time_format)
-                elif column.name == 'quality':
-                    column.value = quality
-            else:
-                try:
-                    column.value, column.quality = column.get_value(date)
-                except (RuntimeError, IOError):
-                    # RuntimeError means a data gap within files was found.
-                    # IOError implies missing file (most likely beyond end of data in archive)
-                    if mind_the_gaps:  # Be stringent and raise the exception
-                        raise
-                    else:
-                        column.quality = 1
-                        column.value = None
+    With ``append`` the output continues an existing outfile from the grid date after
+    its last time stamp (see get_append_start()), so only the new dates are fetched.
+    """
+    def __init__(self,
+                 obsid=None,
+                 outfile=None,
+                 statusfile=None,
+                 status_interval=5,
+                 max_size=None,
+                 ignore_quality=False,
+                 mind_the_gaps=False,
+                 debug=False,
+                 start=None,
+                 stop=None,
+                 dt=32.8,
+                 out_format=None,
+                 time_format='secs',
+                 colspecs=['ephin2eng:'],
+                 prefetch=0,
+                 workers=1,
+                 status_callback=None,
+                 checkpointfile=None,
+                 resume=False,
+                 append=False):
+        self.column_defs, self.headers = get_fetch_columns(colspecs, ignore_quality)
+        self.values = []
+        self.out_format = out_format
+
+        if checkpointfile is None and statusfile:
+            checkpointfile = statusfile + '.checkpoint'
+        if not (outfile and out_format) or workers > 1:
+            checkpointfile = None
+        self.checkpointfile = checkpointfile
+        # Arguments that determine the output, which must match to resume
+        self.args = dict(obsid=obsid, outfile=outfile, ignore_quality=ignore_quality,
+                         mind_the_gaps=mind_the_gaps, start=start, stop=stop, dt=dt,
+                         out_format=out_format, time_format=time_format,
+                         colspecs=list(colspecs))
+        checkpoint = self.read_checkpoint() if resume and checkpointfile else None
+        self.finished = bool(checkpoint and checkpoint['finished'])
+
+        dates, self.datestart, datestop, n_dates = get_date_stamps(start, stop, dt, obsid)
+        self.dt = dt
+
+        # Continue an existing output file from after its last row
+        writer_state = checkpoint and checkpoint['writer']
+        start_day = None
+        if checkpoint:
+            self.datestart = checkpoint['datestart']
+        elif append and outfile and os.path.exists(outfile):
+            writer_state, last_stamp = read_output(out_format, outfile, self.headers)
+            if last_stamp is not None:
                 try:
-                    quality |= column.quality
-                except TypeError:
-                    if not numpy.isnan(column.quality):
-                        raise
+                    precision = time_precision(last_stamp, time_format)
+                    last_date = parse_time(last_stamp, time_format)
+                except Exception:
+                    raise ValueError('Cannot read %s time stamp %s of the last row of %s'
+                                     % (time_format, last_stamp, outfile))
+                # A time stamp in another time format reads as a date outside the archive
+                import Chandra.Time
+                if not (Chandra.Time.DateTime('1999:001').secs <= last_date
+                        <= Chandra.Time.DateTime(time.time(), format='unix').secs):
+                    raise ValueError('Time stamp %s of the last row of %s is not in %s format'
+                                     % (last_stamp, outfile, time_format))
+                if precision >= dt / 2:
+                    raise ValueError('%s time stamps in %s are too coarse to append at '
+                                     'dt=%s' % (time_format, outfile, dt))
+                next_date = get_append_start(last_date, self.datestart, dt, precision)
+                if next_date > self.datestart:
+                    self.datestart = next_date
+                    n_dates = max(int((datestop - next_date) / dt), 0)
+                    start_day = add_days(*(date_to_day(next_date) + (-1,)))
+            logger.info('Appending to %s from date %s' % (outfile, self.datestart))
+
+        # Output goes to outfile if specified, otherwise stdout (text formats only)
+        if self.finished:
+            self.writer = None
+        else:
+            self.writer = get_writer(out_format, outfile, writer_state)
+        if self.writer and writer_state is None:
+            self.writer.write_header(self.headers)
+
+        self.status = FetchStatus(self.datestart, datestop, n_dates, self.headers,
+                                  statusfile=statusfile,
+                                  status_interval=status_interval,
+                                  outfile=outfile,
+                                  max_size=max_size,
+                                  callback=status_callback,
+                                  checkpoint=self.write_checkpoint if checkpointfile else None)
+
+        # Progress through the date grid, updated by iter_records()
+        self.progress = dict(i_date=0, next_date=self.datestart, walk_days={})
+        if checkpoint:
+            self.progress.update(checkpoint['progress'])
+            self.status.current_row = self.progress['i_date']
+            self.status.last_row = self.progress['i_date']
+            logger.info('Resuming fetch to %s at date %s' % (outfile, self.progress['next_date']))
+        self.chunks = iter_records(self.column_defs, self.progress['next_date'], datestop, dt,
+                                   ignore_quality, mind_the_gaps, time_format, prefetch,
+                                   workers, self.status, progress=self.progress,
+                                   start_day=start_day, write_done=False)
+
+    def read_checkpoint(self):
+        """Return the checkpoint to resume from, or None to start from the beginning"""
+        try:
+            checkpoint = cPickle.load(open(self.checkpointfile, 'rb'))
+        except (IOError, EOFError):
+            logger.info('No checkpoint to resume from, starting fetch from the beginning')
+            return None
+        if checkpoint['args'] != self.args:
+            raise ValueError('Checkpoint %s is for a different fetch' % self.checkpointfile)
+        return checkpoint
+
+    def write_checkpoint(self, finished=False):
+        checkpoint = dict(args=self.args,
+                          datestart=self.datestart,
+                          progress=dict(self.progress),
+                          writer=None if finished else self.writer.checkpoint(),
+                          finished=finished)
+        tmpfile = '%s.tmp%d' % (self.checkpointfile, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            cPickle.dump(checkpoint, f, cPickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpfile, self.checkpointfile)
+
+    def _date(self):
+        return self.datestart + self.status.current_row * self.dt
+
+    date = property(_date)
+
+    def step(self):
+        """Output the next chunk of rows.  Return False once the fetch is done."""
+        if self.finished and not self.writer:
+            # Resumed after the output was complete
+            self.chunks.close()
+            self.status.write_statusfile('done')
+            return False
+        try:
+            chunk = self.chunks.next()
+        except StopIteration:
+            if self.writer:
+                with stats.timer('write'):
+                    self.writer.close()
+                stats.count('bytes_written', self.writer.bytes_written)
+                self.finished = True
+                if self.checkpointfile:
+                    self.write_checkpoint(finished=True)
+            # Only report done once the output is complete
+            self.status.write_statusfile('done')
+            return False
 
-        if (not quality or ignore_quality):
-            vals = write_output(columns, out_format, 'value')
-            if out_format is None:
-                output_values.append(vals)
+        out_columns = []
+        for column_def, name in zip(self.column_defs, chunk.dtype.names):
+            vals = chunk.data[name]
+            if vals.dtype.kind == 'S':
+                vals = vals.view(numpy.chararray)
+            elif column_def['table'] == 'pseudo_column':
+                # Date and quality as Python values so text output is e.g. str(float)
+                vals = vals.tolist()
+            bad = chunk.mask[name]
+            out_columns.append((vals, bad if bad.any() else None))
+
+        if self.writer:
+            with stats.timer('write'):
+                self.writer.write_rows(out_columns)
+            self.status.check_filesize(self.writer.bytes_written)
+        elif self.out_format is None:
+            out_lists = []
+            for vals, bad in out_columns:
+                vals = list(vals)
+                if bad is not None:
+                    for i in numpy.flatnonzero(bad):
+                        vals[i] = None
+                out_lists.append(vals)
+            self.values.extend(zip(*out_lists))
+        return True
+
+def fetch_shared(kwargs_list):
+    """
+    Run a fetch for each dict of fetch() keyword args in ``kwargs_list`` as one
+    shared scan of the archive.  The fetches are stepped a chunk at a time, always
+    advancing the one that is furthest behind in time, so each day table is read
+    into data_table.table_cache once and then used by every fetch covering that day.
+    Each fetch still writes its own output with its own columns, dt and format, and
+    a fetch that fails does not stop the others.
+
+    :rtype: list with (headers, values) or the exception raised for each fetch
+    """
+    if any(x.get('profile') for x in kwargs_list):
+        stats.enable()
+    else:
+        stats.disable()
+    files_not_found.clear()
+
+    results = [None] * len(kwargs_list)
+    runs = {}
+    for i, kwargs in enumerate(kwargs_list):
+        kwargs = dict((key, val) for key, val in kwargs.items() if key != 'profile')
+        try:
+            runs[i] = FetchRun(**kwargs)
+        except (Exception, SystemExit), err:
+            results[i] = err
 
-        if status.check_now(i_date):
-            status.write_statusfile()
-            status.check_filesize()
+    while runs:
+        i = min(runs, key=lambda x: runs[x].date)
+        try:
+            if runs[i].step():
+                continue
+            results[i] = (runs[i].headers, runs[i].values)
+        except (Exception, SystemExit), err:
+            runs[i].chunks.close()
+            results[i] = err
+        del runs[i]
+
+    return results
+
+def fetch_iter(obsid=None,
+               statusfile=None,
+               status_interval=5,
+               ignore_quality=False,
+               mind_the_gaps=False,
+               start=None,
+               stop=None,
+               dt=32.8,
+               time_format='secs',
+               colspecs=['ephin2eng:'],
+               prefetch=0,
+               workers=1,
+               chunk_rows=10000):
+    """
+    Fetch data from the telemetry archive as a stream of record array chunks.  Only
+    one chunk of rows is in memory at a time so memory use does not depend on the
+    length of the time range.  Parameters are the same as for fetch() plus:
 
-    # Drop all tables currently associated with columns.  This is to force destruction of
-    # any pyfits objects that are still being referenced at program exit (leaving tmp files around).
-    for column in columns:
-        column.drop_table()
+    :param chunk_rows: Maximum number of rows in each chunk
 
-    status.check_now(i_date)
-    status.write_statusfile('done')
+    :rtype: headers, chunks = tuple of column names, generator of numpy masked
+            structured arrays with one field per column (duplicate column names are
+            made unique) where the mask is set for bad values
+    """
+    files_not_found.clear()
+    column_defs, headers = get_fetch_columns(colspecs, ignore_quality)
+    dates, datestart, datestop, n_dates = get_date_stamps(start, stop, dt, obsid)
+    status = FetchStatus(datestart, datestop, n_dates, headers,
+                         statusfile=statusfile,
+                         status_interval=status_interval)
+    chunks = iter_records(column_defs, datestart, datestop, dt, ignore_quality,
+                          mind_the_gaps, time_format, prefetch, workers, status,
+                          chunk_rows)
+    return headers, chunks
+
+def get_fetch_columns(colspecs, ignore_quality=False):
+    """Return the list of column definitions for the fetch output columns (including
+    date and optionally quality) and the tuple of column names."""
+    with stats.timer('columns'):
+        catalog = get_catalog(SKA_DATA + '/tables')
+
+        # Create data column definitions for each requested column name (along with
+        # date and quality)
+        column_defs = [{'table':'pseudo_column', 'name':'date'}]
+        column_defs.extend(get_column_defs(catalog, colspecs))
+    if ignore_quality:
+        column_defs.append({'table':'pseudo_column', 'name':'quality'})
 
-    if outfile:
-        sys.stdout = sys_stdout
-        f_outfile.close()
-        
-    return output_headers, output_values
+    return column_defs, tuple(x['name'] for x in column_defs)
+
+def iter_records(column_defs, datestart, datestop, timedel, ignore_quality=False,
+                 mind_the_gaps=False, time_format='secs', prefetch=0, workers=1,
+                 status=None, chunk_rows=10000, progress=None, start_day=None,
+                 write_done=True):
+    """Generate output rows for the uniform date grid from datestart up to datestop
+    (Chandra secs) as numpy masked structured arrays of up to chunk_rows rows.  Chunks
+    with no output rows are skipped.  ``status`` is an optional FetchStatus that is
+    updated as the date grid is processed, ending with the done status unless
+    ``write_done`` is False (the caller writes it once the output is complete).
+    ``start_day`` is passed to iter_chunk_values().
+
+    ``progress`` is an optional dict of the number of dates done (i_date), the next
+    date of the grid (next_date) and the day file walk state of each table type
+    (walk_days), which is updated once the rows of each chunk have been consumed.
+    Given the progress of an earlier fetch (with datestart = next_date) the output
+    continues exactly where that fetch stopped.  Progress is not kept for workers > 1.
+    """
+    names = unique_names([x['name'] for x in column_defs])
+    if status:
+        status.write_statusfile()
+
+    # Get values for the date grid in chunks, either here or in parallel worker
+    # processes for day-aligned shards.  Then output the rows in time order.
+    if workers > 1:
+        chunks = iter_shard_values(column_defs, datestart, datestop, timedel, mind_the_gaps,
+                                   prefetch, workers, chunk_rows, start_day)
+    else:
+        chunks = iter_chunk_values(column_defs, datestart, datestop, timedel, mind_the_gaps,
+                                   prefetch, start_day, chunk_size=chunk_rows,
+                                   walk_days=progress and progress['walk_days'])
+    i_date = progress['i_date'] if progress else 0
+    for date_chunk, quality, column_vals in chunks:
+        with stats.timer('records'):
+            # Select good quality rows unless all rows are wanted
+            i_rows = (slice(None) if ignore_quality
+                      else numpy.flatnonzero(quality == 0))
+
+            arrays = []
+            masks = []
+            for column_def in column_defs:
+                bad = None
+                if column_def['table'] == 'pseudo_column':
+                    if column_def['name'] == 'date':
+                        with stats.timer('time_format'):
+                            vals = convert_times(date_chunk[i_rows], time_format)
+                    elif column_def['name'] == 'quality':
+                        vals = quality[i_rows]
+                else:
+                    vals, bad = column_vals[column_def['table'], column_def['name']]
+                    vals = vals[i_rows]
+                    bad = bad[i_rows]
+                arrays.append(vals)
+                masks.append(bad)
+
+            n_rows = len(arrays[0])
+            if n_rows:
+                dtype = numpy.dtype([(name, vals.dtype) for name, vals in zip(names, arrays)])
+                data = numpy.empty(n_rows, dtype=dtype)
+                mask = numpy.zeros(n_rows, dtype=[(name, bool) for name in names])
+                for name, vals, bad in zip(names, arrays, masks):
+                    data[name] = vals
+                    if bad is not None:
+                        mask[name] = bad
+                chunk = numpy.ma.array(data, mask=mask)
+        stats.count('rows_output', n_rows)
+        if n_rows:
+            yield chunk
+
+        i_date += len(date_chunk)
+        if progress is not None:
+            progress['i_date'] = i_date
+            progress['next_date'] = float(date_chunk[-1] + timedel)
+        if status and status.check_now(i_date):
+            status.write_statusfile()
+
+    if status:
+        status.check_now(i_date)
+        if write_done:
+            status.write_statusfile('done')
+
+def iter_chunk_values(column_defs, datestart, datestop, timedel, mind_the_gaps=False,
+                      prefetch=0, start_day=None, chunk_size=10000, walk_days=None):
+    """Generate column values for the uniform date grid from datestart up to datestop
+    (Chandra secs) in chunks of up to chunk_size dates.  ``start_day`` = (year, doy)
+    starts the day file walk as if the dates before datestart had already been
+    processed (see get_shards()).  ``walk_days`` is an optional dict of the (year,
+    doy) day file walk position by table type, which is restored at the start and
+    updated after each chunk.
+
+    :rtype: generator of (dates, quality, column_vals) where column_vals is a dict of
+            (values, bad) arrays keyed by (table_type, column name)
+    """
+    columns = [DataColumn(x) for x in column_defs]
+    groups = get_column_groups(columns)
+
+    # Find the day files covering the time range for each table type
+    for group in groups:
+        group.plan_files(datestart, datestop)
+        if start_day and not group.indexed(datestart - timedel):
+            group.set_start_day(*start_day)
+        if walk_days and group.table_type in walk_days:
+            group.year, group.doy = walk_days[group.table_type]
+
+    if prefetch and groups:
+        prefetcher = TablePrefetcher(prefetch, n_threads=min(prefetch * len(groups), 8))
+        for group in groups:
+            group.prefetcher = prefetcher
+
+    # For each chunk every table type is read in a single vectorized pass
+    try:
+        for date_chunk in get_date_chunks(datestart, datestop, timedel, chunk_size):
+            quality = numpy.zeros(len(date_chunk), dtype=int)
+            column_vals = {}
+            for group in groups:
+                values, group_quality, bad = group.get_values(date_chunk, mind_the_gaps)
+                quality |= group_quality
+                for name in group.names:
+                    column_vals[group.table_type, name] = (values[name], bad)
+                if walk_days is not None:
+                    walk_days[group.table_type] = (group.year, group.doy)
+            yield date_chunk, quality, column_vals
+    finally:
+        # Drop all tables currently associated with columns.  The tables stay available
+        # to later fetches in this process through data_table.table_cache.
+        for group in groups:
+            group.drop_table()
+            if group.prefetcher:
+                group.prefetcher.close()
+                group.prefetcher = None
+
+def fetch_shard(args):
+    """Get all the chunk values for one shard along with the fetch stats of the
+    shard.  Runs in a worker process."""
+    stats.reset()
+    chunks = list(iter_chunk_values(*args))
+    return chunks, stats.as_dict()
+
+def iter_shard_values(column_defs, datestart, datestop, timedel, mind_the_gaps=False,
+                      prefetch=0, workers=2, chunk_size=10000, start_day=None):
+    """Generate the same chunks as iter_chunk_values() but process day-aligned shards
+    of the date grid in a pool of ``workers`` processes.  Shard results are returned
+    in time order as soon as each is done.  At most 2 * workers shards are running
+    or waiting to be returned at once, so memory use does not depend on the length
+    of the time range however slowly the chunks are consumed."""
+    from multiprocessing import Pool
+    from collections import deque
+
+    shard_args = iter([(column_defs, shard_start, shard_stop, timedel, mind_the_gaps, prefetch,
+                        start_day, chunk_size)
+                       for shard_start, shard_stop, start_day
+                       in get_shards(datestart, datestop, timedel, start_day=start_day)])
+    pool = Pool(workers)
+    pending = deque()
+    try:
+        for args in shard_args:
+            pending.append(pool.apply_async(fetch_shard, (args,)))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            shard_chunks, shard_stats = pending.popleft().get()
+            # Start the next shard before handing back the chunks of this one
+            args = next(shard_args, None)
+            if args is not None:
+                pending.append(pool.apply_async(fetch_shard, (args,)))
+            stats.merge(shard_stats)
+            for chunk in shard_chunks:
+                yield chunk
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def get_shards(datestart, datestop, timedel, shard_days=1, start_day=None):
+    """Split the uniform date grid between datestart and datestop into shards at the
+    first grid date of each ``shard_days`` day boundary.
+
+    :rtype: list of (shard_start, shard_stop, start_day) where shard_start is the exact
+            grid date that starts the shard, shard_stop is the start of the next shard
+            (or datestop) and start_day is the (year, doy) before the day of shard_start
+            (``start_day`` for the first shard)
+    """
+    year, doy = date_to_day(datestart)
+    boundaries = []
+    while True:
+        year, doy = add_days(year, doy, shard_days)
+        boundary = day_start(year, doy)
+        if boundary >= datestop:
+            break
+        boundaries.append(boundary)
+
+    shards = []
+    shard_start = datestart
+    i_boundary = 0
+    for dates in get_date_chunks(datestart, datestop, timedel, chunk_size=100000):
+        while i_boundary < len(boundaries) and boundaries[i_boundary] <= dates[-1]:
+            date = dates[numpy.searchsorted(dates, boundaries[i_boundary])]
+            if date > shard_start:
+                shards.append((shard_start, date, start_day))
+                shard_start = date
+                start_day = add_days(*(date_to_day(date) + (-1,)))
+            i_boundary += 1
+    shards.append((shard_start, datestop, start_day))
+    return shards
 
 class FetchStatus(object):
     """
@@ -159,31 +603,39 @@ class FetchStatus(object):
                  status_interval=None,
                  outfile=None,
                  max_size=None,
+                 callback=None,
+                 checkpoint=None,
                  ):
         self.statusfile= statusfile
+        self.callback = callback
+        self.checkpoint = checkpoint
         self.status_interval = status_interval
         self.outfile = outfile
         self.max_size = max_size
         self.total_rows = n_dates
         self.percent_complete = 0
         self.row_interval = 100       # Check time every 100 rows
+        self.last_row = 0
         self.last_time = 0.0
         self.process_start = time.ctime()
         self.current_row = 0
         self.current_time = time.ctime()
+        import Chandra.Time
         self.datestart = Chandra.Time.DateTime(datestart).date
         self.datestop = Chandra.Time.DateTime(datestop).date
-        self.columns = ' '.join([x.name for x in columns])
+        self.columns = ' '.join(columns)
         self.error = None
         self.filesize = 0
+        self.stats = {}
         self.print_attrs = ('current_row', 'total_rows', 'percent_complete',
                             'process_start', 'current_time',
                             'datestart', 'datestop', 
-                            'columns', 'status', 'error')
+                            'columns', 'status', 'error', 'stats')
         
     def check_now(self, current_row):
         self.current_row = current_row
-        if current_row % self.row_interval == 0:
+        if current_row == 0 or current_row - self.last_row >= self.row_interval:
+            self.last_row = current_row
             t = time.time()
             if t - self.last_time > self.status_interval:
                 self.last_time = t
@@ -192,63 +644,68 @@ class FetchStatus(object):
             return False
 
     def write_statusfile(self, status='active'):
-        if not self.statusfile:
+        if self.checkpoint and status == 'active':
+            self.checkpoint()
+        if not (self.statusfile or self.callback):
             return
 
-        self.percent_complete = '%.1f' % (100. * self.current_row / self.total_rows)
+        # Nothing to do (e.g. no new dates to append) counts as complete
+        self.percent_complete = '%.1f' % (100. * self.current_row / self.total_rows
+                                          if self.total_rows else 100.)
         self.current_time = time.ctime()
         self.status = status
+        self.stats = stats.as_dict()
         vals = dict((x, getattr(self, x)) for x in self.print_attrs)
-        cPickle.dump(vals, open(self.statusfile, 'w'))
+        if self.statusfile:
+            cPickle.dump(vals, open(self.statusfile, 'w'))
+        if self.callback:
+            self.callback(vals)
 
-    def check_filesize(self):
+    def check_filesize(self, filesize):
         if self.max_size and self.outfile:
-            self.filesize = os.stat(self.outfile).st_size
+            self.filesize = filesize
             if self.filesize > self.max_size:
                 self.error = 'file size limit %d bytes exceeded' % self.max_size
                 self.write_statusfile('error')
                 sys.exit(1)
 
-class InvalidTableOrColumn(LookupError):
-    """Custom exception if no matching table or column is found"""
-        
-def write_output(columns, out_format, attr):
-    values = tuple(getattr(x, attr) for x in columns)
-
-    field_seps = {'dmascii': ' ',
-                  'space': ' ',
-                  'csv': ',',
-                  'tab': '\t',
-                  'rdb': '\t'}
-    field_sep = field_seps.get(out_format)
-                 
-    if out_format == 'dmascii' and attr == 'name':
-        print '#',
-    if out_format in field_seps:
-        print field_sep.join(str(x) for x in values)
-    elif out_format == 'fits':
-        raise RuntimeError('Sorry, FITS output format not yet supported')
-
-    return values
+def get_append_start(last_date, datestart, timedel, precision=0.0):
+    """Return the date grid date after ``last_date``, the time stamp (Chandra secs) of
+    the last row of existing output, which is only good to ``precision``.  If it is on
+    the grid from datestart to within that precision then the next date of that grid
+    is returned, otherwise the output is continued on its own grid if the time stamp
+    is good to a millisecond."""
+    i_date = int(round((last_date - datestart) / timedel))
+    if i_date >= 0 and abs(last_date - (datestart + i_date * timedel)) <= precision:
+        return get_grid_date(datestart, timedel, i_date + 1)
+    if precision > 0.001:
+        raise ValueError('Last time stamp of the output is too coarse to continue from '
+                         'and is not on the date grid from the start time: append with '
+                         'the start time of the original fetch')
+    return last_date + timedel
+
+def get_grid_date(datestart, timedel, i_date, chunk_size=1000000):
+    """Return date ``i_date`` of the uniform grid from datestart.  The dates are
+    accumulated sequentially as in get_date_chunks(), which can differ from
+    datestart + i_date * timedel in the last digits."""
+    date = datestart
+    while i_date > 0:
+        n_steps = min(i_date, chunk_size)
+        steps = numpy.empty(n_steps + 1, dtype=numpy.float64)
+        steps[0] = date
+        steps[1:] = timedel
+        date = numpy.add.accumulate(steps)[-1]
+        i_date -= n_steps
+    return float(date)
 
 def get_date_stamps(start, stop, timedel, obsid):
     """Generate datetime values corresponding to a uniform sampling between
     start and stop
     """
     # Use Chandra.Time.DateTime to convert most any input format to YYYY:DOY:HH:MM:SS
+    import Chandra.Time
     if obsid:
-        conn = sqlite.connect(os.path.join(os.environ.get('SKA', '/proj/sot/ska'),
-                                           'data/telem_archive/db.sql3'))
-        cur = conn.cursor()
-        cur.execute("SELECT kalman_tstart, kalman_tstop FROM observations WHERE obsid=?",
-                    (obsid,))
-        vals = cur.fetchall()
-        if len(vals) == 0:
-            raise RuntimeError, 'No observations matching obsid = %d' % obsid
-        elif len(vals) > 1:
-            raise RuntimeError, 'Multiple observations matching obsid = %d' % obsid
-        start = vals[0][0]
-        stop = vals[0][1]
+        start, stop = get_obsid_times(obsid)
 
     if not start or not stop:
         raise RuntimeError, 'Start and/or stop time not provided'
@@ -270,81 +727,94 @@ def get_date_stamps(start, stop, timedel, obsid):
 
     return gen_date_stamps, datestart, datestop, int((datestop - datestart) / timedel)
 
-def get_column_defs(table_defs, args):
+def get_obsid_times(obsid):
+    """Return the kalman_tstart, kalman_tstop of ``obsid`` from the observations
+    database.  Lookups are cached in this process until the database file changes."""
+    db_file = os.path.join(os.environ.get('SKA', '/proj/sot/ska'), 'data/telem_archive/db.sql3')
+    db_key = (db_file, os.path.exists(db_file) and os.path.getmtime(db_file))
+    if db_key not in obsid_times:
+        obsid_times.clear()
+        obsid_times[db_key] = {}
+    times = obsid_times[db_key]
+
+    if obsid not in times:
+        import sqlite3 as sqlite
+        conn = sqlite.connect(db_file)
+        cur = conn.cursor()
+        cur.execute("SELECT kalman_tstart, kalman_tstop FROM observations WHERE obsid=?",
+                    (obsid,))
+        vals = cur.fetchall()
+        conn.close()
+        if len(vals) == 0:
+            raise RuntimeError, 'No observations matching obsid = %d' % obsid
+        elif len(vals) > 1:
+            raise RuntimeError, 'Multiple observations matching obsid = %d' % obsid
+        times[obsid] = tuple(vals[0])
+
+    return times[obsid]
+
+# Cached obsid (kalman_tstart, kalman_tstop) by obsid for the current database file
+obsid_times = {}
+
+def get_date_chunks(datestart, datestop, timedel, chunk_size=10000):
+    """Generate arrays of up to chunk_size date values corresponding to a uniform
+    sampling between datestart and datestop (Chandra secs).  The dates are
+    accumulated sequentially so they are identical to the values from
+    get_date_stamps().
+    """
+    date = datestart
+    while date < datestop:
+        steps = numpy.empty(chunk_size + 1, dtype=numpy.float64)
+        steps[0] = date
+        steps[1:] = timedel
+        dates = numpy.add.accumulate(steps)
+        n_dates = numpy.searchsorted(dates[:-1], datestop)
+        yield dates[:n_dates]
+        date = dates[-1]
+
+def get_column_defs(catalog, args):
     """Parse supplied args to find table/column specifiers, and find
-    those columns within the table definitions (table_defs).
+    those columns within the table catalog (TableCatalog).
     Allowed syntax::
 
      <table>:<col1>,...   # col1,... in specified table
      <col1>,..            # col1,... in any table (must be unique)
      @<filename>          # File <filename> containing lines in above format
     """
-    def get_columns_in_table(table_name, col_names):
-        """Find specified col_names in table_name.  If table_name is not
-        provided then look in all tables in within table_defs.  Return
-        list of dicts (table, name) for each column."""
-        columns = []
-        if table_name:
-            if table_name not in table_defs:
-                raise InvalidTableOrColumn, "No table named %s" % table_name
-
-            table_columns = table_defs[table_name]['columns']
-            skip_cols = ['time', 'quality']
-            skip_cols += [x['name'] for x in table_columns if not x.get('is_output', True)]
-            table_col_names = [x['name'] for x in table_columns if x['name'] not in skip_cols]
-
-            if not col_names:
-                col_names = table_col_names
-
-            for col_name in col_names:
-                if col_name not in table_col_names:
-                       raise InvalidTableOrColumn, \
-                             "No column %s in %s table" % (col_name, table_name)
-                columns.append({'table': table_name,
-                                'name' : col_name})
-        else:
-            for col_name in col_names:
-                for table_name in table_defs:
-                    try:
-                        column = get_columns_in_table(table_name, [col_name])
-                        break
-                    except InvalidTableOrColumn:
-                        pass
-                else:
-                    raise InvalidTableOrColumn('Column %s not found in any table' % col_name)
-
-                columns += column
-
-        return columns
-    
+    from pyparsing import ParseException
     columns = []
-    table_name = Word(alphanums + '_-').setResultsName("table_name") + ':'
-    col_name = Word(alphanums + '_-')
-    opt_table_and_cols = Optional(table_name) + \
-                         delimitedList(col_name).setResultsName("col_names")
-    arg_parse = lineStart + ( opt_table_and_cols | table_name ) + lineEnd
+    arg_parse = get_colspec_grammar()
     for arg in args:
         try:
             results = arg_parse.parseString(arg)
         except ParseException, msg:
             raise ParseException("Bad column specifier syntax in %s" % arg)
-            
-        columns += get_columns_in_table(results.table_name, results.col_names)
+
+        if results.table_name:
+            columns += catalog.get_table_columns(results.table_name, results.col_names)
+        else:
+            columns += [catalog.find_column(x) for x in results.col_names]
 
     return columns
 
+def get_colspec_grammar():
+    """Return the pyparsing grammar for a column specifier (built once per process)"""
+    global colspec_grammar
+    if colspec_grammar is None:
+        from pyparsing import (Word, alphanums, delimitedList, Optional, lineStart,
+                               lineEnd)
+        table_name = Word(alphanums + '_-').setResultsName("table_name") + ':'
+        col_name = Word(alphanums + '_-')
+        opt_table_and_cols = Optional(table_name) + \
+                             delimitedList(col_name).setResultsName("col_names")
+        colspec_grammar = lineStart + ( opt_table_and_cols | table_name ) + lineEnd
+    return colspec_grammar
+
+colspec_grammar = None
+
 def get_table_defs(table_dir):
     """ Read all the table definition files in specified table_dir """
-    from glob import glob
-    import yaml
-    table_files = glob(table_dir + '/*.yml')
-    assert table_files, 'No table files found'
-
-    table_def = {}
-    for filename in table_files:
-        table_name = re.sub(r'\.yml$', '', os.path.basename(filename))
-        table_def[table_name] = yaml.load(open(filename).read())
-    return table_def
+    return get_catalog(table_dir).table_defs
 
 def get_options():
     from optparse import OptionParser
@@ -360,6 +830,19 @@ def get_options():
     parser.add_option("--statusfile",
                       help="Write out fetch status each status-interval seconds",
                       )
+    parser.add_option("--checkpointfile",
+                      help="Checkpoint file for --resume (default = <statusfile>.checkpoint)",
+                      )
+    parser.add_option("--resume",
+                      action="store_true",
+                      default=False,
+                      help="Continue the output from the last checkpoint of an interrupted fetch",
+                      )
+    parser.add_option("--append",
+                      action="store_true",
+                      default=False,
+                      help="Append rows after the last time stamp of an existing outfile",
+                      )
     parser.add_option("--status-interval",
                       default=2,
                       type="float",
@@ -392,14 +875,29 @@ def get_options():
                       )
     parser.add_option("--file-format",
                       default='csv',
-                      choices=['csv','rdb','space','fits','tab','dmascii'],
-                      help="Output data format (csv rdb space fits tab dmascii)",
+                      choices=['csv','rdb','space','fits','tab','dmascii','npz','hdf5'],
+                      help="Output data format (csv rdb space fits tab dmascii npz hdf5)",
                       )
     parser.add_option("--time-format",
                       default='date',
                       choices=['date','greta','secs','jd','mjd','fits','unix'],
                       help="Output time format (date greta secs jd mjd fits unix)",
                       )
+    parser.add_option("--prefetch",
+                      type='int',
+                      default=0,
+                      help="Number of day files per table to read ahead in background threads",
+                      )
+    parser.add_option("--workers",
+                      type='int',
+                      default=1,
+                      help="Number of processes fetching day-aligned time shards in parallel",
+                      )
+    parser.add_option("--profile",
+                      action="store_true",
+                      default=False,
+                      help="Print time spent in each fetch stage and counters when done",
+                      )
     parser.add_option("--debug",
                       action="store_true",
                       default=False,
@@ -2,12 +2,15 @@ import socket
 from signal import signal, SIGALRM, alarm
 import pickle
 
+from Ska.TelemArchive.fetch_protocol import TERMINATOR, MessageBuffer, encode_frame
+
 # user-accessible port
 HOST = 'baffin'
 PORT = 18039
 
-# Unlikely sequence of characters to terminate conversation
-TERMINATOR = "\_$|)<~};!)}]+/)()]\;}&|&*\\%_$^^;;-+=:_;\\<|\'-_/]*?`-"
+# Protocol used by send().  Servers before the framed protocol do not answer framed
+# requests, so this stays legacy until all servers have been upgraded.
+PROTOCOL = 0
 
 class TimeoutError(Exception):
     pass
@@ -15,7 +18,69 @@ class TimeoutError(Exception):
 def timeout_handler(signum, frame):
     raise TimeoutError
 
-def send(action, host=HOST, port=PORT):
+class Connection(object):
+    """
+    Persistent connection to the fetch server.  Several requests can be sent with
+    send() before reading their responses in order with receive(), and request()
+    does both for one request.  Socket operations time out after ``timeout`` sec.
+
+    Example::
+
+      with Connection('localhost', 18039) as conn:
+          jobs = conn.request(dict(cmd='get_status'))
+    """
+    def __init__(self, host=HOST, port=PORT, timeout=5):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.buffer = MessageBuffer(legacy=False)
+        self.responses = []
+
+    def send(self, action):
+        self.sock.sendall(encode_frame(action))
+
+    def receive(self):
+        while not self.responses:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError('Connection closed by fetch server')
+            self.buffer.feed(data)
+            self.responses.extend(self.buffer.messages())
+        return self.responses.pop(0)
+
+    def request(self, action):
+        self.send(action)
+        return self.receive()
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+def send(action, host=HOST, port=PORT, protocol=PROTOCOL):
+    """Send ``action`` to the fetch server on a new connection and return the
+    response.  Use protocol=fetch_protocol.VERSION (or a Connection) for the framed
+    protocol, which only upgraded servers have."""
+    if protocol == 0:
+        return send_legacy(action, host, port)
+
+    try:
+        server = Connection(host, port)
+    except socket.error:
+        return [dict(client_error='Socket connection error')]
+
+    try:
+        response = server.request(action)
+    except Exception, e:
+        response = [dict(client_error=e)]
+
+    server.close()
+    return response
+
+def send_legacy(action, host=HOST, port=PORT):
     try:
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.connect((host, port))
@@ -43,4 +108,3 @@ def send(action, host=HOST, port=PORT):
 
     server.close()
     return response
-
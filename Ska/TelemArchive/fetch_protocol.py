@@ -0,0 +1,118 @@
+"""
+Wire protocol between fetch_client and fetch_server.
+
+Each message is sent as a frame: a header of MAGIC, the protocol version (unsigned
+byte) and the payload length (unsigned 32-bit int, network byte order) followed by
+the payload, which is a pickled request dict or response.  A connection stays open
+for any number of requests, and several requests can be sent before reading the
+responses, which come back in request order.
+
+The legacy protocol (version 0) is one pickled request followed by TERMINATOR per
+connection, with the response terminated the same way.  The server tells the two
+apart by the first bytes received on a connection.
+"""
+__docformat__ = 'restructuredtext'
+import struct
+import cPickle
+
+MAGIC = '\x93SKA'
+VERSION = 1
+HEADER = struct.Struct('!4sBI')
+MAX_PAYLOAD = 64 * 1024**2
+
+# Unlikely sequence of characters to terminate conversation (legacy protocol)
+TERMINATOR = "\_$|)<~};!)}]+/)()]\;}&|&*\\%_$^^;;-+=:_;\\<|\'-_/]*?`-"
+
+class ProtocolError(Exception):
+    pass
+
+def encode_frame(obj, version=VERSION):
+    """Return the frame for message ``obj``"""
+    payload = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(MAGIC, version, len(payload)) + payload
+
+def encode_legacy(obj):
+    """Return ``obj`` as a legacy protocol message"""
+    return cPickle.dumps(obj) + TERMINATOR
+
+class MessageBuffer(object):
+    """
+    Accumulate data received on a connection and split off complete messages.  Data
+    is only joined once a whole frame (or a legacy TERMINATOR) has arrived, so the
+    cost is linear in the message size however small the reads are.
+    """
+    def __init__(self, legacy=None):
+        self.legacy = legacy      # None until the first bytes show the protocol
+        self.version = None
+        self.chunks = []
+        self.n_bytes = 0
+        self.need = HEADER.size
+        self.tail = ''
+        self.terminated = False
+
+    def __len__(self):
+        return self.n_bytes
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.n_bytes += len(data)
+        if self.legacy is None:
+            start = self._join()[:len(MAGIC)]
+            if not MAGIC.startswith(start):
+                self.legacy = True
+                data = self.chunks[0]
+            elif len(start) == len(MAGIC):
+                self.legacy = False
+        if self.legacy and not self.terminated:
+            # Only search the new data (and enough of the old to catch a split TERMINATOR)
+            data = self.tail + data
+            self.terminated = TERMINATOR in data
+            self.tail = data[-(len(TERMINATOR) - 1):]
+
+    def _join(self):
+        if len(self.chunks) != 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0]
+
+    def _consume(self, n):
+        data = self._join()
+        self.chunks = [data[n:]] if n < len(data) else []
+        self.n_bytes -= n
+
+    def messages(self):
+        """Return the list of complete messages received so far"""
+        if self.legacy is None:
+            return []
+        elif self.legacy:
+            return self._legacy_messages()
+
+        msgs = []
+        while self.n_bytes >= self.need:
+            data = self._join()
+            magic, version, length = HEADER.unpack_from(data)
+            if magic != MAGIC:
+                raise ProtocolError('Bad frame header')
+            if version != VERSION:
+                raise ProtocolError('Unsupported protocol version %d (expected %d)'
+                                    % (version, VERSION))
+            if length > MAX_PAYLOAD:
+                raise ProtocolError('Frame payload of %d bytes is too long' % length)
+            self.need = HEADER.size + length
+            if self.n_bytes < self.need:
+                break
+            self.version = version
+            msgs.append(cPickle.loads(data[HEADER.size:self.need]))
+            self._consume(self.need)
+            self.need = HEADER.size
+        return msgs
+
+    def _legacy_messages(self):
+        if not self.terminated:
+            return []
+        data = self._join()
+        i = data.index(TERMINATOR)
+        msg = cPickle.loads(data[:i])
+        self._consume(i + len(TERMINATOR))
+        self.terminated = False
+        self.tail = ''
+        return [msg]
@@ -3,30 +3,45 @@ import os
 import re
 import cPickle
 import optparse
+import errno
 import socket
-import signal
 import stat
 import time
 import pprint
 import shutil
+import heapq
+import select
 import logging
+import resource
+import multiprocessing
 import Ska.TelemArchive.fetch
+from Ska.TelemArchive.fetch_protocol import (MessageBuffer, ProtocolError, encode_frame,
+                                             encode_legacy)
+from Ska.TelemArchive.shm_cache import shm_cache
 
 SKA = os.getenv('SKA') or '/proj/sot/ska'
 SKA_DATA = os.path.join(SKA, 'data', 'telem_archive')
 
-# Unlikely sequence of characters to terminate conversation
-TERMINATOR = "\_$|)<~};!)}]+/)()]\;}&|&*\\%_$^^;;-+=:_;\\<|\'-_/]*?`-"
+# Only pay attention to these keys in run_fetch kwargs.  Others are ignored.
+ALLOWED_KEYS = ('obsid', 'start', 'stop', 'dt', 'out_format', 'time_format', 'colspecs')
 
-class TimeoutError(Exception):
-    pass
+# Rough costs (sec) used to estimate the run time of a fetch job
+DAY_FILE_COST = 0.05        # Read and decode one day file
+VALUE_COST = 1e-6           # Look up one column value
+ROW_COST = 5e-6             # Format and write one output row
 
-def timeout_handler(signum, frame):
-    raise TimeoutError
+# Fraction of the days of each of two jobs that they must share to run in one scan
+MIN_SHARED_DAYS = 0.5
 
 class FetchJobs(object):
     def __init__(self):
         self.jobs = []
+        self.by_id = {}
+        self.by_key = {}           # Jobs by fetch_key(), newest first
+        self.last_write = {}       # Time job and status files were last written by jobid
+        self.dedup_requests = 0
+        self.dedup_hits = 0
+        self.last_clean = time.time()
 
         # Find existing jobs and clean expired directories
         jobids = self.clean_jobs()
@@ -38,9 +53,17 @@ class FetchJobs(object):
             outdir = os.path.join(opt.outroot, jobid)
             try:
                 job = cPickle.load(open(os.path.join(opt.outroot, jobid, opt.jobfile)))
-            except IOError:
-                logging.info('Jobfile for %s failed to load during init %.1f' % outdir)
+            except (IOError, EOFError, cPickle.UnpicklingError):
+                logging.info('Jobfile for %s failed to load during init' % outdir)
                 continue
+            try:
+                job.update(cPickle.load(open(job['statusfile'])))
+            except (IOError, EOFError, cPickle.UnpicklingError):
+                pass
+            if job['status'] in ('starting', 'active'):
+                job['status'] = 'error'
+                job['error'] = 'Fetch interrupted by server restart'
+                self.write_job(job)
             logging.info('Adding job %s' % jobid)
             self.add(job)
 
@@ -52,7 +75,7 @@ class FetchJobs(object):
         jobids = []
         for jobid in self.get_jobids():
             outdir = os.path.join(opt.outroot, jobid)
-            if time.time() - os.stat(outdir)[stat.ST_MTIME] > opt.max_age * 86400:
+            if expired(outdir):
                 logging.info('Removing directory %s because age exceeds %.1f' % (outdir, opt.max_age))
                 shutil.rmtree(outdir)
             elif not os.path.exists(os.path.join(outdir, opt.jobfile)):
@@ -86,96 +109,574 @@ class FetchJobs(object):
         self.add(job)
 
         os.makedirs(outdir)
-        cPickle.dump(job, open(job['jobfile'], 'w'))
-        cPickle.dump(job, open(job['statusfile'], 'w'))
+        self.write_job(job)
 
         return job
 
     def add(self, job):
         self.jobs.insert(0, job)
+        self.by_id[job['jobid']] = job
+        self.index(job)
+
+    def index(self, job):
+        """Add ``job`` to the deduplication index"""
+        if 'fetch_key' not in job and 'colspecs' in job:
+            # Job from before fetch keys were recorded
+            job['fetch_key'] = fetch_key(job)
+        if job.get('fetch_key') is not None:
+            self.by_key.setdefault(job['fetch_key'], []).insert(0, job)
+
+    def reindex(self):
+        self.by_key = {}
+        for job in reversed(self.jobs):
+            self.index(job)
+
+    def find_duplicate(self, key):
+        """Return the newest job with fetch ``key`` that is running or done with its
+        output still available, or None"""
+        self.dedup_requests += 1
+        for job in self.by_key.get(key, []):
+            if (job['status'] in ('queued', 'starting', 'active')
+                or (job['status'] == 'done' and os.path.exists(job['outfile'])
+                    and not expired(job['outdir']))):
+                self.dedup_hits += 1
+                break
+        else:
+            job = None
+        logging.info('Fetch dedup %s (hit rate %d/%d = %.1f%%)'
+                     % ('hit on job %s' % job['jobid'] if job else 'miss',
+                        self.dedup_hits, self.dedup_requests,
+                        100.0 * self.dedup_hits / self.dedup_requests))
+        return job
+
+    def remove_expired(self):
+        """Remove expired job directories and drop their jobs"""
+        jobids = set(self.clean_jobs())
+        self.jobs = [x for x in self.jobs if x['jobid'] in jobids]
+        self.by_id = dict((x['jobid'], x) for x in self.jobs)
+        for jobid in [x for x in self.last_write if x not in jobids]:
+            del self.last_write[jobid]
+        self.reindex()
+        self.last_clean = time.time()
 
     def _n_active(self):
-        return len([x for x in self.jobs if x['status'] == 'active'])
+        return len([x for x in self.jobs if x['status'] in ('starting', 'active')])
 
     n_active = property(_n_active)
 
-    def update_jobs(self):
-        """Read statusfiles and update corresponding job structure and file"""
-        jobs = []
-        for job in self.jobs:
-            if os.path.exists(job['statusfile']):
-                job.update(cPickle.load(open(job['statusfile'])))
-                cPickle.dump(job, open(job['jobfile'], 'w'))
-                jobs.append(job)
-            else:
-                logging.warning('No status file for %s, removing job' % job['jobid'])
-        self.jobs = jobs
-            
-def run_fetch(job, kwargs):
-    # Only pay attention to these keys in kwargs.  Others are ignored.
-    allowed_keys = ('obsid', 'start', 'stop', 'dt', 'out_format',
-                    'time_format', 'colspecs')
-    
-    fetch_kwargs = dict(outfile=job['outfile'],
-                        statusfile=job['statusfile'],
-                        status_interval=opt.status_interval,
-                        max_size=opt.max_size,
-                        ignore_quality=False,
-                        mind_the_gaps=False,
+    def update_job(self, jobid, vals):
+        """Update job ``jobid`` with status ``vals`` sent by a worker.  The job is
+        written to its job and status files when the status changes, otherwise at most
+        once every status_interval seconds."""
+        job = self.by_id.get(jobid)
+        if job is None:
+            return
+        changed = vals.get('status', job['status']) != job['status']
+        job.update(vals)
+        if changed or time.time() - self.last_write.get(jobid, 0) >= opt.status_interval:
+            self.write_job(job)
+
+    def write_job(self, job):
+        dump_atomic(job, job['jobfile'])
+        dump_atomic(job, job['statusfile'])
+        self.last_write[job['jobid']] = time.time()
+
+def dump_atomic(obj, filename):
+    """Pickle ``obj`` to ``filename`` by way of a temporary file so readers never
+    see a partly written file"""
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'w') as f:
+        cPickle.dump(obj, f)
+    os.rename(tmpfile, filename)
+
+def expired(outdir):
+    """Return True if job directory ``outdir`` is older than max_age"""
+    return time.time() - os.stat(outdir)[stat.ST_MTIME] > opt.max_age * 86400
+
+def get_fetch_kwargs(kwargs):
+    """Return the allowed keys of run_fetch ``kwargs`` with defaults filled in"""
+    fetch_kwargs = dict(obsid=None,
                         start=None,
                         stop=None,
                         dt=32.8,
                         out_format='csv',
                         time_format='secs',
                         colspecs=['ephin2eng:'])
+    fetch_kwargs.update((x, kwargs[x]) for x in kwargs if x in ALLOWED_KEYS)
+    return fetch_kwargs
+
+def fetch_key(kwargs):
+    """Return a canonical key for the output of a fetch with ``kwargs`` (see
+    get_fetch_kwargs()).  Dates are compared as Chandra secs so that requests for the
+    same data in the same format match however the dates are written.  Return None
+    if the request cannot be canonicalized."""
+    import Chandra.Time
+    try:
+        if kwargs.get('obsid'):
+            dates = ('obsid', int(kwargs['obsid']))
+        else:
+            dates = tuple(None if kwargs.get(x) is None
+                          else round(Chandra.Time.DateTime(kwargs[x]).secs, 3)
+                          for x in ('start', 'stop'))
+        return repr((dates,
+                     float(kwargs['dt']),
+                     str(kwargs['out_format']),
+                     str(kwargs['time_format']),
+                     tuple(str(x).strip() for x in kwargs['colspecs'])))
+    except Exception:
+        return None
+            
+class FetchWorker(object):
+    """Worker process and the pipe on which it receives lists of (job, fetch_kwargs)
+    and sends (jobid, status dict) messages"""
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.ready = False         # Waiting for jobs
+        self.jobids = []           # Jobs the worker is running
+        self.started = set()       # Jobs the worker has sent active status for
+        self.closed = False        # Pipe closed by worker
+
+    def fileno(self):
+        return self.conn.fileno()
+
+class WorkerPool(object):
+    """
+    Pool of long-lived fetch worker processes.  Each worker keeps the table catalog,
+    decoded day tables and obsid lookups warm from one job to the next.  A worker
+    exits after ``max_jobs`` jobs or once its RSS exceeds ``max_rss`` bytes and
+    maintain() starts a replacement.  Jobs are sent to idle workers with dispatch(),
+    several at a time for a shared scan, and the workers send job status back, which
+    the server reads with receive().
+    """
+    def __init__(self, n_workers, max_jobs=None, max_rss=None, close_on_fork=()):
+        self.n_workers = n_workers
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.close_on_fork = close_on_fork
+        self.workers = []
+        self.maintain()
+
+    def readers(self):
+        return [x for x in self.workers if not x.closed]
+
+    def idle_workers(self):
+        return [x for x in self.workers
+                if x.ready and not x.closed and x.process.is_alive()]
+
+    def running_jobids(self):
+        return [jobid for x in self.workers for jobid in x.jobids]
+
+    def running_groups(self):
+        """Return the list of jobids running on each busy worker"""
+        return [list(x.jobids) for x in self.workers if x.jobids]
+
+    def receive(self, worker):
+        """Return the list of (jobid, status dict) messages waiting from ``worker``"""
+        msgs = []
+        try:
+            while worker.conn.poll():
+                jobid, vals = worker.conn.recv()
+                if jobid is None:
+                    worker.ready = vals.get('ready', False)
+                    continue
+                if vals.get('status') == 'active':
+                    worker.started.add(jobid)
+                elif vals.get('status') in ('done', 'error') and jobid in worker.jobids:
+                    worker.jobids.remove(jobid)
+                msgs.append((jobid, vals))
+        except (EOFError, IOError):
+            worker.closed = True
+        return msgs
+
+    def dispatch(self, worker, batch):
+        """Send ``batch`` (list of (job, fetch_kwargs)) to be run by ``worker``"""
+        worker.ready = False
+        worker.jobids = [job['jobid'] for job, fetch_kwargs in batch]
+        worker.started = set()
+        try:
+            worker.conn.send(batch)
+        except IOError:
+            # Worker died since it was ready.  The jobs are queued again when it is reaped.
+            worker.closed = True
+
+    def _reap(self, worker):
+        """Return the final messages from exited ``worker``, including an error for
+        each job it started but did not finish.  Jobs it never started are left for
+        the scheduler to queue again."""
+        worker.process.join()
+        logging.info('Fetch worker pid %d exited with code %s'
+                     % (worker.process.pid, worker.process.exitcode))
+        msgs = self.receive(worker)
+        for jobid in worker.jobids:
+            if jobid in worker.started:
+                msgs.append((jobid, dict(status='error', error='Fetch worker exited')))
+        worker.jobids = []
+        worker.conn.close()
+        return msgs
+
+    def maintain(self):
+        """Reap exited workers and start new ones to keep n_workers running.  Return
+        the last messages from the exited workers."""
+        msgs = []
+        for worker in [x for x in self.workers if not x.process.is_alive()]:
+            msgs.extend(self._reap(worker))
+            self.workers.remove(worker)
+        while len(self.workers) < self.n_workers:
+            conn, worker_conn = multiprocessing.Pipe()
+            close_on_fork = list(self.close_on_fork) + [x.conn for x in self.workers] + [conn]
+            process = multiprocessing.Process(target=worker_main,
+                                              args=(worker_conn, self.max_jobs,
+                                                    self.max_rss, close_on_fork))
+            process.daemon = True
+            process.start()
+            worker_conn.close()
+            logging.info('Started fetch worker pid %d' % process.pid)
+            self.workers.append(FetchWorker(process, conn))
+        return msgs
+
+    def close(self, timeout=10):
+        """Stop the workers once they finish their current job.  Return the last
+        messages from the workers."""
+        msgs = []
+        for worker in self.readers():
+            try:
+                worker.conn.send(None)
+            except IOError:
+                pass
+        tstop = time.time() + timeout
+        while time.time() < tstop and any(x.process.is_alive() for x in self.workers):
+            for worker in self.readers():
+                msgs.extend(self.receive(worker))
+            time.sleep(0.05)
+        for worker in self.workers:
+            if worker.process.is_alive():
+                logging.warning('Terminating fetch worker pid %d' % worker.process.pid)
+                worker.process.terminate()
+            msgs.extend(self._reap(worker))
+        self.workers = []
+        return msgs
+
+class JobScheduler(object):
+    """
+    Queue of fetch jobs waiting for a worker.  The cost of each job is estimated when
+    it is submitted and queued jobs are started cheapest first, with the priority of
+    a job improving by ``aging`` sec of cost for each second it waits so that long
+    jobs are not starved.
+
+    Queued jobs that read most of the same day files as the job being started are
+    sent along with it to the same worker (up to ``max_shared`` jobs in all), which
+    runs them as one shared scan of the archive with fetch_shared().  A shared scan
+    finishes with its longest job, so expensive jobs only join a batch started by an
+    expensive job.  At most
+    ``max_running`` workers are busy at once, of which at most ``max_expensive`` run
+    a job with an estimated cost above ``expensive_cost`` sec.
+    """
+    def __init__(self, jobs, pool, max_running, max_expensive, expensive_cost, aging,
+                 max_shared=1):
+        self.jobs = jobs
+        self.pool = pool
+        self.max_running = max_running
+        self.max_expensive = max_expensive
+        self.expensive_cost = expensive_cost
+        self.aging = aging
+        self.max_shared = max_shared
+        self.queue = []            # (job, fetch_kwargs)
+        self.scans = {}            # jobid: day files read by the queued job (see get_scan())
+        self.starting = {}         # jobid: (job, fetch_kwargs) sent to a worker
+
+    def submit(self, job, fetch_kwargs):
+        scan = get_scan(fetch_kwargs)
+        self.scans[job['jobid']] = scan
+        job['estimated_cost'] = estimate_cost(scan)
+        job['status'] = 'queued'
+        job['systime_queued'] = time.time()
+        self.queue.append((job, fetch_kwargs))
+        logging.info('Queued job %s with estimated cost %.1f sec'
+                     % (job['jobid'], job['estimated_cost']))
+
+    def expensive(self, jobs):
+        return any(x.get('estimated_cost', 0) > self.expensive_cost for x in jobs)
+
+    def overlap(self, job, other):
+        """Return True if queued jobs ``job`` and ``other`` read some of the same
+        tables over at least MIN_SHARED_DAYS of the days of each job"""
+        scan = self.scans.get(job['jobid'])
+        other_scan = self.scans.get(other['jobid'])
+        if not (scan and other_scan and scan['tables'] & other_scan['tables']):
+            return False
+        n_shared = (min(scan['day1'], other_scan['day1'])
+                    - max(scan['day0'], other_scan['day0']) + 1)
+        return all(n_shared >= MIN_SHARED_DAYS * (x['day1'] - x['day0'] + 1)
+                   for x in (scan, other_scan))
+
+    def running_groups(self):
+        """Return the list of jobs running on each busy worker"""
+        return [[self.jobs.by_id[x] for x in jobids if x in self.jobs.by_id]
+                for jobids in self.pool.running_groups()]
+
+    def queue_order(self, now):
+        """Return the queue in priority order"""
+        return sorted(self.queue, key=lambda x: (x[0]['estimated_cost']
+                                                 - self.aging * (now - x[0]['systime_queued'])))
+
+    def dispatch(self):
+        """Start the highest priority queued jobs that are allowed to run on idle
+        workers, each along with the queued jobs that overlap it"""
+        running_jobids = self.pool.running_jobids()
+        for jobid, item in self.starting.items():
+            if item[0]['status'] != 'starting':
+                del self.starting[jobid]
+            elif jobid not in running_jobids:
+                logging.warning('Queueing job %s again after its worker exited' % jobid)
+                del self.starting[jobid]
+                item[0]['status'] = 'queued'
+                self.queue.append(item)
+
+        workers = self.pool.idle_workers()
+        if not (workers and self.queue):
+            return
+        groups = self.running_groups()
+        n_running = len(groups)
+        n_expensive = len([x for x in groups if self.expensive(x)])
+        queue = self.queue_order(time.time())
+        while workers and n_running < self.max_running:
+            batch = []
+            for item in queue:
+                if batch and (len(batch) >= self.max_shared
+                              or not self.overlap(batch[0][0], item[0])):
+                    continue
+                if self.expensive([item[0]]) and not self.expensive([x[0] for x in batch]):
+                    # Do not hold up a cheap job until an expensive one is done
+                    if batch or n_expensive >= self.max_expensive:
+                        continue
+                    n_expensive += 1
+                batch.append(item)
+            if not batch:
+                break
+
+            for item in batch:
+                job = item[0]
+                queue.remove(item)
+                self.queue.remove(item)
+                del self.scans[job['jobid']]
+                for key in ('queue_position', 'estimated_start'):
+                    job.pop(key, None)
+                job['status'] = 'starting'
+                job['systime_started'] = time.time()
+                self.starting[job['jobid']] = item
+                self.jobs.write_job(job)
+            if len(batch) > 1:
+                logging.info('Starting jobs %s in a shared scan'
+                             % ' '.join(str(x[0]['jobid']) for x in batch))
+            self.pool.dispatch(workers.pop(0), batch)
+            n_running += 1
+
+    def update_estimates(self):
+        """Set queue_position and estimated_start (unix time) of each queued job,
+        assuming that every job takes its estimated cost and queued jobs start in the
+        current priority order"""
+        now = time.time()
+        slots = []
+        expensive_stops = []
+        for jobs in self.running_groups():
+            remaining = max([0.0] + [x['estimated_cost'] - (now - x['systime_started'])
+                                     for x in jobs])
+            slots.append(remaining)
+            if self.expensive(jobs):
+                expensive_stops.append(remaining)
+        n_slots = max(1, min(self.max_running, self.pool.n_workers))
+        slots.extend([0.0] * (n_slots - len(slots)))
+        heapq.heapify(slots)
+
+        for i, (job, fetch_kwargs) in enumerate(self.queue_order(now)):
+            start = heapq.heappop(slots)
+            if self.expensive([job]):
+                stops = sorted(x for x in expensive_stops if x > start)
+                if len(stops) >= self.max_expensive:
+                    start = stops[len(stops) - self.max_expensive]
+                expensive_stops.append(start + job['estimated_cost'])
+            job['queue_position'] = i + 1
+            job['estimated_start'] = now + start
+            heapq.heappush(slots, start + job['estimated_cost'])
+
+def get_scan(fetch_kwargs):
+    """Return dict of the table types, first and last day (days since 1998.0) and
+    numbers of dates and columns that a fetch with ``fetch_kwargs`` reads, or None
+    if the fetch cannot be set up (e.g. bad column specifier)"""
+    fetch = Ska.TelemArchive.fetch
+    try:
+        column_defs, headers = fetch.get_fetch_columns(fetch_kwargs['colspecs'])
+        dates, datestart, datestop, n_dates = fetch.get_date_stamps(
+            fetch_kwargs['start'], fetch_kwargs['stop'], fetch_kwargs['dt'],
+            fetch_kwargs['obsid'])
+    except Exception:
+        return None
+    tables = frozenset(x['table'] for x in column_defs if x['table'] != 'pseudo_column')
+    return dict(tables=tables,
+                day0=int(datestart // 86400),
+                day1=int(datestop // 86400),
+                n_dates=max(0, n_dates),
+                n_columns=len([x for x in column_defs if x['table'] in tables]))
+
+def estimate_cost(scan):
+    """Return the estimated run time (sec) of a fetch that reads ``scan`` (from
+    get_scan()).  A fetch that cannot be set up fails right away so its cost is 0."""
+    if scan is None:
+        return 0.0
+    n_days = max(0, scan['day1'] - scan['day0'] + 1)
+    return (len(scan['tables']) * n_days * DAY_FILE_COST
+            + scan['n_dates'] * (scan['n_columns'] * VALUE_COST + ROW_COST))
+
+def get_rss():
+    """Return the resident set size of this process (bytes), not counting shared
+    pages such as memory-mapped column store or shared table cache columns"""
+    try:
+        pages = [int(x) for x in open('/proc/self/statm').read().split()]
+        return (pages[1] - pages[2]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # Peak RSS is the best available estimate
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def warm_up():
+    """Load the modules and table catalog that every fetch needs"""
+    import Chandra.Time
+    import pyfits
+    from Ska.TelemArchive.table_catalog import get_catalog
+    get_catalog(Ska.TelemArchive.fetch.SKA_DATA + '/tables')
+    Ska.TelemArchive.fetch.get_colspec_grammar()
+
+def worker_main(conn, max_jobs, max_rss, close_on_fork):
+    """Run batches of jobs received on ``conn`` until None is received or it is time
+    to recycle this worker.  Job status is sent to the server on ``conn``, along with
+    a ready message whenever the worker is waiting for jobs."""
+    for sock in close_on_fork:
+        sock.close()
+    try:
+        warm_up()
+    except Exception, msg:
+        logging.warning('Fetch worker warm up failed: %s' % msg)
 
-    # Update allowed key values in fetch_kwargs
-    fetch_kwargs.update((x, kwargs[x]) for x in kwargs if x in allowed_keys )
+    n_jobs = 0
+    while True:
+        conn.send((None, dict(ready=True)))
+        try:
+            item = conn.recv()
+        except EOFError:
+            break
+        if item is None:
+            break
+        run_jobs(item, conn)
 
-    # Incorporate fetch keyword args into job and store
-    job.update(fetch_kwargs)
-        
-    pid = os.fork()
-    if pid:
-        job['pid'] = pid
-        return
+        n_jobs += len(item)
+        if max_jobs and n_jobs >= max_jobs:
+            logging.info('Recycling fetch worker pid %d after %d jobs' % (os.getpid(), n_jobs))
+            break
+        rss = get_rss()
+        if max_rss and rss > max_rss:
+            logging.info('Recycling fetch worker pid %d with RSS %.1f MB'
+                         % (os.getpid(), rss / 1024.**2))
+            break
 
-    logging.info('Running fetch() in pid %d with kwargs:\n%s' % (os.getpid(), pprint.pformat(fetch_kwargs)))
+    # Worker processes exit without running atexit handlers
+    shm_cache.release_all()
+
+def status_sender(jobid, status_pipe):
+    """Return function that sends a status dict for ``jobid`` to the server"""
+    def send_status(vals):
+        status_pipe.send((jobid, vals))
+    return send_status
+
+def run_jobs(batch, status_pipe):
+    """Run fetch_shared() for the list of (job, fetch_kwargs) in ``batch`` in a worker
+    process, sending the fetch status of each job to the server instead of writing
+    the statusfile"""
+    kwargs_list = []
+    for job, fetch_kwargs in batch:
+        send_status = status_sender(job['jobid'], status_pipe)
+        send_status(dict(status='active', pid=os.getpid()))
+        logging.info('Running fetch() for job %s in pid %d with kwargs:\n%s'
+                     % (job['jobid'], os.getpid(), pprint.pformat(fetch_kwargs)))
+        kwargs_list.append(dict(fetch_kwargs, status_callback=send_status))
 
     try:
-        headers, data = Ska.TelemArchive.fetch.fetch(**fetch_kwargs)
+        results = Ska.TelemArchive.fetch.fetch_shared(kwargs_list)
     except Exception, msg:
-        # Something bombed so write jobfile and statusfile here
-        logging.warning('Fetch failed with msg: %s' % msg)
-        job['status'] = 'error'
-        job['error'] = str(msg)
-        logging.warning('job = %s' % pprint.pformat(job))
-        cPickle.dump(job, open(job['jobfile'], 'w'))
-        cPickle.dump(job, open(job['statusfile'], 'w'))
+        results = [msg] * len(batch)
+
+    for (job, fetch_kwargs), kwargs, result in zip(batch, kwargs_list, results):
+        if isinstance(result, SystemExit):
+            # Output file size limit exceeded.  fetch() already sent the error status.
+            logging.warning('Fetch exited for job %s' % job['jobid'])
+        elif isinstance(result, Exception):
+            # Something bombed so send the error status here
+            logging.warning('Fetch failed with msg: %s' % result)
+            logging.warning('job = %s' % pprint.pformat(job))
+            kwargs['status_callback'](dict(status='error', error=str(result)))
+
+def run_fetch(job, kwargs, scheduler, resume=False):
+    # Status goes to the server from the worker instead of to job['statusfile'].  With
+    # ``resume`` the output continues from the last checkpoint of the job (if any).
+    fetch_kwargs = dict(outfile=job['outfile'],
+                        status_interval=opt.status_interval,
+                        max_size=opt.max_size,
+                        ignore_quality=False,
+                        mind_the_gaps=False,
+                        profile=opt.profile)
 
-    sys.exit(0)
+    # Update allowed key values in fetch_kwargs
+    fetch_kwargs.update(get_fetch_kwargs(kwargs))
 
-def server_action(action, jobs):
+    # Incorporate fetch keyword args into job and store
+    job.update(fetch_kwargs)
+    job['fetch_key'] = fetch_key(fetch_kwargs)
+    fetch_kwargs.update(checkpointfile=job['statusfile'] + '.checkpoint',
+                        resume=resume)
+    scheduler.submit(job, fetch_kwargs)
+
+def server_action(action, jobs, scheduler):
     cmd = action.get('cmd')
     kwargs = action.get('kwargs')
 
-    jobs.update_jobs()
-
     logging.info("Server action cmd: %s" % cmd)
     if cmd == 'get_status':
+        scheduler.update_estimates()
         return jobs.jobs
 
     elif cmd == 'run_fetch':
-        if jobs.n_active >= opt.max_jobs:
-            logging.warning('Maximum active jobs (%d) exceeded' % opt.max_jobs)
-            return [dict(error='Maximum active jobs (%d) exceeded' % opt.max_jobs)]
+        kwargs = kwargs or {}
+        # Hand back an identical job that is done or still running
+        job = jobs.find_duplicate(fetch_key(get_fetch_kwargs(kwargs)))
+        if job is not None:
+            return [job] + [x for x in jobs.jobs if x is not job]
+
+        if len(scheduler.queue) >= opt.max_queued:
+            logging.warning('Maximum queued jobs (%d) exceeded' % opt.max_queued)
+            return [dict(error='Maximum queued jobs (%d) exceeded' % opt.max_queued)]
 
         job = jobs.create_job()
-        run_fetch(job, kwargs)
-        cPickle.dump(job, open(job['jobfile'], 'w'))    
+        run_fetch(job, kwargs, scheduler)
+        jobs.index(job)
+        jobs.write_job(job)
 
         return jobs.jobs
 
+    elif cmd == 'resume_job':
+        # Run a failed job again, continuing its output from the last checkpoint
+        job = jobs.by_id.get(str((kwargs or {}).get('jobid')))
+        if job is None:
+            return [dict(error='No job %s' % (kwargs or {}).get('jobid'))]
+        if job['status'] != 'error':
+            return [dict(error='Job %s is %s, not error' % (job['jobid'], job['status']))]
+        if not os.path.exists(job['statusfile'] + '.checkpoint'):
+            return [dict(error='Job %s has no checkpoint to resume from' % job['jobid'])]
+
+        job.pop('error', None)
+        run_fetch(job, job, scheduler, resume=True)
+        jobs.write_job(job)
+
+        return [job] + [x for x in jobs.jobs if x is not job]
+
     elif cmd == 'stop_server':
         logging.info('Stopping fetch server')
         return 'Stopping fetch server'
@@ -187,6 +688,83 @@ def server_action(action, jobs):
 def sigint_handler(signal, frame):
     raise Exception
 
+class ClientConnection(object):
+    """
+    State of one client connection in the server event loop.  Requests are read and
+    responses written without blocking.  Each request must be received and answered
+    within ``timeout`` seconds of its first bytes, and a connection that is idle for
+    ``idle_timeout`` seconds is dropped.  Framed protocol connections stay open for
+    more requests (see fetch_protocol) while legacy protocol connections are closed
+    after the response.
+    """
+    def __init__(self, channel, address, timeout, idle_timeout):
+        self.channel = channel
+        self.address = address
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.buffer = MessageBuffer()
+        self.msg_send = ''
+        self.busy_since = None
+        self.last_active = time.time()
+        self.closing = False
+        channel.setblocking(0)
+
+    def fileno(self):
+        return self.channel.fileno()
+
+    def _deadline(self):
+        if self.busy_since is not None:
+            return self.busy_since + self.timeout
+        return self.last_active + self.idle_timeout
+
+    deadline = property(_deadline)
+
+    def _idle(self):
+        return not (len(self.buffer) or self.msg_send)
+
+    idle = property(_idle)
+
+    def read(self):
+        """Read available data.  Return the list of complete requests."""
+        data = self.channel.recv(65536)
+        if not data:
+            if not self.idle:
+                raise EOFError('Connection closed before request was complete')
+            self.closing = True
+            return []
+        if self.busy_since is None:
+            self.busy_since = time.time()
+        self.buffer.feed(data)
+        actions = self.buffer.messages()
+        for action in actions:
+            if not isinstance(action, dict):
+                raise ValueError('Request is not a dict')
+        return actions
+
+    def respond(self, response):
+        if self.buffer.legacy:
+            # Legacy connections close once the response has been sent
+            self.msg_send += encode_legacy(response)
+            self.closing = True
+        else:
+            self.msg_send += encode_frame(response)
+
+    def write(self):
+        """Send as much of the queued responses as possible.  Return True once the
+        connection is done."""
+        n = self.channel.send(self.msg_send)
+        self.msg_send = self.msg_send[n:]
+        if not self.msg_send:
+            if self.closing:
+                return True
+            if not len(self.buffer):
+                self.busy_since = None
+                self.last_active = time.time()
+        return False
+
+    def close(self):
+        self.channel.close()
+
 def server():
     logging.basicConfig(filename=opt.logfile, level=logging.INFO,
                         format='%(asctime)s %(levelname)s: %(message)s')
@@ -197,48 +775,135 @@ def server():
     try:
         service = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         service.bind(("", opt.port))
-        service.listen(1)
+        service.listen(socket.SOMAXCONN)
+        service.setblocking(0)
     except socket.error:
         logging.debug("Socket already in use (probably normal)")
         sys.exit(0)
 
     logging.info("Listening on port %d" % opt.port)
 
-    while True:
-        # serve forever
-        channel, info = service.accept()
-        logging.info("Connection from %s on port %d" % (str(info), opt.port))
-
-        prev_alarm_handler = signal.signal(signal.SIGALRM, timeout_handler)
+    # Sockets that worker processes close when they start
+    open_sockets = [service]
+    if opt.shm_cache_mb is not None:
+        # Workers share decoded day tables through /dev/shm
+        shm_cache.set_max_bytes(int(opt.shm_cache_mb * 1024**2))
+    pool = WorkerPool(opt.workers,
+                      max_jobs=opt.worker_max_jobs,
+                      max_rss=opt.worker_max_rss and opt.worker_max_rss * 1024**2,
+                      close_on_fork=open_sockets)
+    scheduler = JobScheduler(jobs, pool,
+                             max_running=opt.max_jobs,
+                             max_expensive=opt.max_expensive_jobs,
+                             expensive_cost=opt.expensive_cost,
+                             aging=opt.aging,
+                             max_shared=opt.max_shared_jobs)
+    connections = []
+
+    # Jobs that were still queued when the server stopped, continuing from any
+    # checkpoint of a resumed job
+    for job in reversed(jobs.jobs):
+        if job['status'] == 'queued':
+            run_fetch(job, job, scheduler, resume=True)
+
+    def drop(conn):
+        conn.close()
+        connections.remove(conn)
+        open_sockets.remove(conn.channel)
+
+    # Serve until a stop_server request has been answered, handling all client
+    # connections in one select() loop and replacing any workers that have exited
+    stopping = False
+    while not (stopping and not connections):
+        for jobid, vals in pool.maintain():
+            jobs.update_job(jobid, vals)
+        if time.time() - jobs.last_clean > opt.clean_interval:
+            jobs.remove_expired()
+        scheduler.dispatch()
+
+        now = time.time()
+        for conn in [x for x in connections if x.deadline < now]:
+            if conn.idle:
+                logging.info('Closing idle connection from %s' % str(conn.address))
+            else:
+                logging.warning('Timeout for connection from %s' % str(conn.address))
+            drop(conn)
+        if stopping:
+            for conn in [x for x in connections if x.idle]:
+                drop(conn)
+
+        readers = [x for x in connections if not x.closing] + pool.readers()
+        writers = [x for x in connections if x.msg_send]
+        if not stopping:
+            readers.append(service)
+        timeout = max(0.0, min([1.0] + [x.deadline - now for x in connections]))
         try:
-            signal.alarm(8)
-
-            # Get the message from client
-            msg_recv = ''
-            while TERMINATOR not in msg_recv:
-                msg_recv += channel.recv(1024)
-            msg_recv = cPickle.loads(msg_recv[:-len(TERMINATOR)])
-
-            # Respond to the request from the received message
-            server_response = server_action(msg_recv, jobs)
-            msg_send = cPickle.dumps(server_response) + TERMINATOR
+            readable, writable = select.select(readers, writers, [], timeout)[:2]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
 
-            # Send the response
-            while msg_send:
-                n = channel.send(msg_send)
-                msg_send = msg_send[n:]
+        for conn in readable:
+            if isinstance(conn, FetchWorker):
+                for jobid, vals in pool.receive(conn):
+                    jobs.update_job(jobid, vals)
+                continue
 
-            signal.alarm(0)
-            signal.signal(signal.SIGALRM, prev_alarm_handler)
-        except TimeoutError, e:
-            logging.warning('TimeoutError')
+            if conn is service:
+                try:
+                    channel, info = service.accept()
+                except socket.error:
+                    continue
+                logging.info("Connection from %s on port %d" % (str(info), opt.port))
+                connections.append(ClientConnection(channel, info, opt.client_timeout,
+                                                    opt.idle_timeout))
+                open_sockets.append(channel)
+                continue
 
-        channel.close() # disconnect
+            try:
+                actions = conn.read()
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    logging.warning('Read error from %s: %s' % (str(conn.address), e))
+                    drop(conn)
+                continue
+            except ProtocolError, e:
+                # Tell the client why, then close the connection
+                logging.warning('Bad request from %s: %s' % (str(conn.address), e))
+                conn.respond([dict(error='Protocol error: %s' % e)])
+                conn.closing = True
+                continue
+            except Exception, e:
+                logging.warning('Bad request from %s: %s' % (str(conn.address), e))
+                drop(conn)
+                continue
+            if conn.closing and conn.idle:
+                drop(conn)   # Client closed the connection
+                continue
 
-        if msg_recv['cmd'] == 'stop_server':
-            break
+            # Respond to each request in order
+            for action in actions:
+                try:
+                    conn.respond(server_action(action, jobs, scheduler))
+                except Exception, e:
+                    logging.exception('Server action %s failed' % str(action.get('cmd')))
+                    conn.respond([dict(error='Server error: %s' % e)])
+                if action.get('cmd') == 'stop_server':
+                    stopping = True
+
+        for conn in writable:
+            try:
+                if conn.write():
+                    drop(conn)   # disconnect
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    logging.warning('Write error to %s: %s' % (str(conn.address), e))
+                    drop(conn)
 
     service.close()
+    for jobid, vals in pool.close():
+        jobs.update_job(jobid, vals)
 
 def get_options():
     parser = optparse.OptionParser()
@@ -272,11 +937,63 @@ def get_options():
     parser.add_option("--max-jobs",
                       default=2,
                       type=int,
-                      help="Maximum active fetch jobs",)
+                      help="Maximum running fetch jobs (others are queued)",)
+    parser.add_option("--max-queued",
+                      default=100,
+                      type=int,
+                      help="Maximum queued fetch jobs",)
+    parser.add_option("--max-expensive-jobs",
+                      default=1,
+                      type=int,
+                      help="Maximum running jobs with estimated cost above expensive-cost",)
+    parser.add_option("--expensive-cost",
+                      default=60,
+                      type=float,
+                      help="Estimated run time above which a job is expensive (sec)",)
+    parser.add_option("--max-shared-jobs",
+                      default=4,
+                      type=int,
+                      help="Maximum overlapping jobs run in one shared scan (1 = no sharing)",)
+    parser.add_option("--aging",
+                      default=1.0,
+                      type=float,
+                      help="Queue priority gain per second of waiting (sec of estimated cost)",)
+    parser.add_option("--client-timeout",
+                      default=8,
+                      type=float,
+                      help="Time allowed for each client request and response (sec)",)
+    parser.add_option("--idle-timeout",
+                      default=60,
+                      type=float,
+                      help="Time an idle client connection is kept open (sec)",)
+    parser.add_option("--workers",
+                      default=2,
+                      type=int,
+                      help="Number of fetch worker processes",)
+    parser.add_option("--worker-max-jobs",
+                      default=100,
+                      type=int,
+                      help="Jobs run by a worker before it is replaced (0 = no limit)",)
+    parser.add_option("--worker-max-rss",
+                      default=1000,
+                      type=float,
+                      help="Worker RSS after a job above which it is replaced (MB, 0 = no limit)",)
+    parser.add_option("--shm-cache-mb",
+                      type=float,
+                      help="Size cap of the day tables shared by workers in /dev/shm "
+                      "(MB, 0 = no sharing, default = $TELEM_ARCHIVE_SHM_MB)",)
     parser.add_option("--max-age",
                       default=3,
                       type=float,
                       help="Maximum age for fetch output files before deletion (days)",)
+    parser.add_option("--profile",
+                      action="store_true",
+                      default=False,
+                      help="Record fetch stage timers and counters in job status",)
+    parser.add_option("--clean-interval",
+                      default=3600,
+                      type=float,
+                      help="Interval between removals of expired job directories (sec)",)
     parser.add_option("--port",
                       default=18001,
                       type=int,
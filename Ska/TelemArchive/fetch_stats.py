@@ -0,0 +1,136 @@
+"""
+Lightweight counters and stage timers for profiling a fetch.
+
+The day table reading, column lookup, time formatting and output writing code
+records into the process-wide ``stats`` object, which does nothing until it is
+enabled (one attribute check per call).  Stage times are exclusive: while a stage
+nested inside another one is timed (e.g. reading a day file during a lookup), the
+outer stage is paused.  Stages are timed separately in each thread, so with
+prefetch threads the stage times can add up to more than the elapsed time.
+"""
+__docformat__ = 'restructuredtext'
+import time
+import threading
+
+# Stages in the order they are listed by FetchStats.summary()
+STAGES = ('columns', 'gunzip', 'fits_decode', 'store_read', 'prefetch_wait', 'lookup',
+          'time_format', 'records', 'write')
+
+class NullTimer(object):
+    """Timer used while stats are disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+null_timer = NullTimer()
+
+class StageTimer(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.t0 = None
+
+    def __enter__(self):
+        stack = self.stats.timer_stack()
+        self.t0 = time.time()
+        if stack:
+            # Pause the enclosing stage
+            outer = stack[-1]
+            self.stats.add_time(outer.name, self.t0 - outer.t0)
+        stack.append(self)
+        return self
+
+    def __exit__(self, *args):
+        stack = self.stats.timer_stack()
+        t1 = time.time()
+        self.stats.add_time(self.name, t1 - self.t0)
+        stack.pop()
+        if stack:
+            stack[-1].t0 = t1
+        return False
+
+class FetchStats(object):
+    """
+    Counters (e.g. files_opened, bytes_decompressed, rows_scanned, cache_hits) and
+    seconds spent in each fetch stage.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.seconds = {}
+            self.tstart = time.time()
+
+    def enable(self):
+        """Reset and start recording"""
+        self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, secs):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + secs
+
+    def timer(self, name):
+        """Return a context manager that adds the time spent within it to stage ``name``"""
+        if not self.enabled:
+            return null_timer
+        return StageTimer(self, name)
+
+    def timer_stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def as_dict(self):
+        """Return dict of counters, stage seconds and elapsed seconds since reset
+        (empty if disabled)"""
+        if not self.enabled:
+            return {}
+        with self.lock:
+            return dict(counters=dict(self.counters),
+                        seconds=dict(self.seconds),
+                        elapsed=time.time() - self.tstart)
+
+    def merge(self, vals):
+        """Add counters and stage seconds from as_dict() output of another process"""
+        if not (self.enabled and vals):
+            return
+        with self.lock:
+            for name, n in vals['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, secs in vals['seconds'].items():
+                self.seconds[name] = self.seconds.get(name, 0.0) + secs
+
+    def summary(self):
+        """Return a printable summary of stage times and counters"""
+        vals = self.as_dict()
+        if not vals:
+            return 'Fetch profiling not enabled'
+        seconds = vals['seconds']
+        names = [x for x in STAGES if x in seconds]
+        names += sorted(x for x in seconds if x not in STAGES)
+        lines = ['Fetch profile (elapsed %.3f sec)' % vals['elapsed'],
+                 '  %-20s %12s' % ('stage', 'sec')]
+        lines += ['  %-20s %12.3f' % (x, seconds[x]) for x in names]
+        lines.append('  %-20s %12s' % ('counter', 'value'))
+        lines += ['  %-20s %12d' % (x, vals['counters'][x]) for x in sorted(vals['counters'])]
+        return '\n'.join(lines)
+
+stats = FetchStats()
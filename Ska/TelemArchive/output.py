@@ -0,0 +1,581 @@
+"""
+Write fetch output in blocks of rows from column arrays.
+
+Text formats (csv, space, tab, rdb, dmascii) are written to a file or stdout.
+Binary formats (fits, npz, hdf5) are written to a file as typed columns.  For
+binary formats bad values are written as NaN for float columns, blank for string
+columns and 0 otherwise; the quality column identifies them.
+
+A writer to a file can be checkpointed, which flushes the output to disk and
+returns the state needed to carry on writing after the rows written so far.  A
+writer created with that state (see get_writer()) drops anything written to the
+file after the checkpoint and continues from there.  The same state can also be
+read back from a complete output file (see read_output()) to append rows to it.
+"""
+__docformat__ = 'restructuredtext'
+import os
+import sys
+import shutil
+import zipfile
+import numpy
+
+def get_writer(out_format, outfile=None, state=None):
+    """Return a writer for ``out_format`` that writes to file ``outfile`` (default
+    stdout for text formats), or None if the format does not produce output
+    (e.g. out_format=None for list output).  If ``state`` from checkpoint() is
+    given then the writer resumes writing the existing ``outfile``."""
+    if state is not None and not outfile:
+        raise ValueError('Resuming output requires an output file')
+    if out_format in TextWriter.field_seps:
+        writer = TextWriter(open(outfile, 'r+' if state else 'w') if outfile else sys.stdout,
+                            out_format)
+    elif out_format in binary_writers:
+        if not outfile:
+            raise ValueError('%s output format requires an output file' % out_format)
+        writer = binary_writers[out_format](outfile, append=state is not None)
+    else:
+        return None
+    if state is not None:
+        writer.resume(state)
+    return writer
+
+def read_output(out_format, outfile, names):
+    """Read back existing fetch output ``outfile`` with columns ``names`` (date
+    first) for appending to it.
+
+    :rtype: state, last_date = writer state for get_writer(), date value of the last
+            row (a string for text formats) or None if there are no rows
+    """
+    if out_format in TextWriter.field_seps:
+        return TextWriter.read_output(outfile, out_format, names)
+    elif out_format in binary_writers:
+        return binary_writers[out_format].read_output(outfile, unique_names(names))
+    else:
+        raise ValueError('Cannot append %s output' % out_format)
+
+def sync(fileobj):
+    fileobj.flush()
+    os.fsync(fileobj.fileno())
+
+def truncate(fileobj, size):
+    """Truncate ``fileobj`` to ``size`` bytes and move to the end"""
+    if os.fstat(fileobj.fileno()).st_size < size:
+        raise ValueError('Output file %s is shorter than at the checkpoint' % fileobj.name)
+    fileobj.truncate(size)
+    fileobj.seek(0, os.SEEK_END)
+
+def unique_names(names):
+    """Return list of ``names`` with duplicates made unique by appending _2, _3, ..."""
+    out_names = []
+    for name in names:
+        unique_name = name
+        i = 2
+        while unique_name in out_names:
+            unique_name = '%s_%d' % (name, i)
+            i += 1
+        out_names.append(unique_name)
+    return out_names
+
+def format_values(values, bad=None):
+    """Return list of str() of each of ``values`` (list or array), with 'None' where
+    ``bad`` is set.  Numeric arrays are formatted once per distinct value, which is a
+    large saving for telemetry that changes slowly compared to the sampling.
+    """
+    if isinstance(values, numpy.ndarray) and len(values):
+        if values.dtype.kind == 'S':
+            strs = numpy.char.rstrip(numpy.asarray(values)).tolist()
+        elif values.dtype.kind in 'biuf':
+            # Use the raw bytes for float values so that e.g. -0.0 and 0.0 are distinct
+            keys = (values.view('u%d' % values.dtype.itemsize)
+                    if values.dtype.kind == 'f' else values)
+            unique_keys, i_first, i_unique = numpy.unique(keys, return_index=True,
+                                                          return_inverse=True)
+            unique_strs = numpy.array([str(values[i]) for i in i_first], dtype=object)
+            strs = unique_strs[i_unique].tolist()
+        else:
+            strs = [str(x) for x in values]
+    else:
+        strs = [str(x) for x in values]
+
+    if bad is not None:
+        for i in numpy.flatnonzero(bad):
+            strs[i] = 'None'
+    return strs
+
+class TextWriter(object):
+    """
+    Write delimited text output.  Each block of rows is formatted column by column and
+    written with a single write() call.  The number of bytes written is tracked so
+    the output size can be checked without a stat() call.
+    """
+    field_seps = {'dmascii': ' ',
+                  'space': ' ',
+                  'csv': ',',
+                  'tab': '\t',
+                  'rdb': '\t'}
+
+    def __init__(self, fileobj, out_format):
+        self.fileobj = fileobj
+        self.out_format = out_format
+        self.field_sep = self.field_seps[out_format]
+        self.bytes_written = 0
+        self.n_rows = 0
+
+    def write(self, text):
+        self.fileobj.write(text)
+        self.bytes_written += len(text)
+
+    def header_line(self, names):
+        header = self.field_sep.join(str(x) for x in names)
+        if self.out_format == 'dmascii':
+            header = '# ' + header
+        return header + '\n'
+
+    def write_header(self, names):
+        self.write(self.header_line(names))
+
+    @classmethod
+    def read_output(cls, outfile, out_format, names):
+        """Return the state for appending to ``outfile`` and the date of its last row.
+        Only the header and the end of the file are read.  A partly written last
+        line is dropped."""
+        fileobj = open(outfile, 'rb')
+        header = fileobj.readline()
+        if header != cls(None, out_format).header_line(names):
+            raise ValueError('Columns of %s do not match the fetch columns' % outfile)
+
+        # Read back from the end of the file until the last complete line is found
+        pos = os.fstat(fileobj.fileno()).st_size
+        tail = ''
+        while pos > len(header) and tail.count('\n') < 2:
+            n_read = min(65536, pos - len(header))
+            pos -= n_read
+            fileobj.seek(pos)
+            tail = fileobj.read(n_read) + tail
+        fileobj.close()
+        tail = tail[:tail.rfind('\n') + 1]
+        lines = tail.splitlines()
+        last_date = lines[-1].split(cls.field_seps[out_format])[0] if lines else None
+
+        return dict(bytes_written=pos + len(tail), n_rows=0), last_date
+
+    def write_rows(self, columns):
+        """Write rows given a list of (values, bad) for each column where values is a
+        list or array and bad is a bool array or None"""
+        col_strs = [format_values(values, bad) for values, bad in columns]
+        if not col_strs or not col_strs[0]:
+            return
+        sep = self.field_sep
+        self.write('\n'.join([sep.join(row) for row in zip(*col_strs)]) + '\n')
+        self.n_rows += len(col_strs[0])
+
+    def checkpoint(self):
+        """Flush output to disk and return the state to resume writing from"""
+        sync(self.fileobj)
+        return dict(bytes_written=self.bytes_written, n_rows=self.n_rows)
+
+    def resume(self, state):
+        truncate(self.fileobj, state['bytes_written'])
+        self.bytes_written = state['bytes_written']
+        self.n_rows = state['n_rows']
+
+    def close(self):
+        if self.fileobj is sys.stdout:
+            self.fileobj.flush()
+        else:
+            self.fileobj.close()
+
+class BinaryWriter(object):
+    """
+    Base class for writers of typed columns.  The column data types are set from the
+    first block of rows and later blocks are converted to those types.
+    """
+    def __init__(self, outfile, append=False):
+        self.outfile = outfile
+        self.append = append
+        self.names = None
+        self.dtypes = None
+        self.bytes_written = 0
+        self.n_rows = 0
+
+    def write_header(self, names):
+        # Binary formats need unique column names
+        self.names = unique_names(names)
+
+    def get_arrays(self, columns):
+        """Return list of arrays for columns of (values, bad) with bad values filled"""
+        arrays = []
+        for i, (values, bad) in enumerate(columns):
+            values = numpy.asarray(values)
+            if self.dtypes is not None:
+                values = values.astype(self.dtypes[i])
+            if bad is not None and bad.any():
+                values = values.copy()
+                values[bad] = {'f': numpy.nan, 'S': ''}.get(values.dtype.kind, 0)
+            arrays.append(values)
+        if self.dtypes is None:
+            self.dtypes = [x.dtype for x in arrays]
+            self.init_columns()
+        return arrays
+
+    def init_columns(self):
+        pass
+
+    def checkpoint(self):
+        """Flush output to disk and return the state to resume writing from"""
+        self.sync()
+        return dict(names=self.names, dtypes=self.dtypes,
+                    bytes_written=self.bytes_written, n_rows=self.n_rows)
+
+    def resume(self, state):
+        self.names = state['names']
+        self.dtypes = state['dtypes']
+        self.bytes_written = state['bytes_written']
+        self.n_rows = state['n_rows']
+        if self.dtypes is not None:
+            self.resume_columns()
+
+    def sync(self):
+        pass
+
+    def resume_columns(self):
+        pass
+
+    def write_rows(self, columns):
+        arrays = self.get_arrays(columns)
+        n_rows = len(arrays[0]) if arrays else 0
+        if n_rows:
+            self.write_arrays(arrays)
+            self.n_rows += n_rows
+
+    def close(self):
+        if self.dtypes is None:
+            # No rows were written so there are no column types: use float
+            self.dtypes = [numpy.dtype(numpy.float64)] * len(self.names)
+            self.init_columns()
+
+class FitsWriter(BinaryWriter):
+    """
+    Write a FITS binary table.  Rows are streamed to the file and the NAXIS2 row
+    count is filled in when the file is closed.
+    """
+    tform_codes = {'b': 'L', 'u1': 'B', 'i1': 'I', 'i2': 'I', 'u2': 'J', 'i4': 'J',
+                   'u4': 'K', 'i8': 'K', 'u8': 'K', 'f4': 'E', 'f8': 'D'}
+    fits_dtypes = {'L': 'S1', 'B': 'u1', 'I': '>i2', 'J': '>i4', 'K': '>i8',
+                   'E': '>f4', 'D': '>f8'}
+    column_dtypes = {'L': 'b1', 'B': 'u1', 'I': 'i2', 'J': 'i4', 'K': 'i8',
+                     'E': 'f4', 'D': 'f8'}
+
+    def __init__(self, outfile, append=False):
+        BinaryWriter.__init__(self, outfile, append)
+        self.fileobj = open(outfile, 'r+b' if append else 'wb')
+
+    @staticmethod
+    def card(key, value=None):
+        if value is None:
+            card = key
+        elif isinstance(value, bool):
+            card = '%-8s= %20s' % (key, 'T' if value else 'F')
+        elif isinstance(value, (int, long)):
+            card = '%-8s= %20d' % (key, value)
+        else:
+            card = "%-8s= '%-8s'" % (key, str(value).replace("'", "''"))
+        return card.ljust(80)
+
+    def write_block(self, cards):
+        header = ''.join(cards + [self.card('END')])
+        header += ' ' * (-len(header) % 2880)
+        self.fileobj.write(header)
+        self.bytes_written += len(header)
+
+    def set_row_dtype(self):
+        self.tforms, self.row_dtype = FitsWriter.get_row_dtype(self.names, self.dtypes)
+
+    @staticmethod
+    def get_row_dtype(names, dtypes):
+        """Return the TFORM of each column and the dtype of the FITS table rows"""
+        tforms = []
+        row_dtype = []
+        for name, dtype in zip(names, dtypes):
+            if dtype.kind == 'S':
+                tform = '%dA' % max(dtype.itemsize, 1)
+                fits_dtype = 'S%d' % max(dtype.itemsize, 1)
+            else:
+                tform = FitsWriter.tform_codes[dtype.kind if dtype.kind == 'b'
+                                               else dtype.kind + str(dtype.itemsize)]
+                fits_dtype = FitsWriter.fits_dtypes[tform]
+            tforms.append(tform)
+            row_dtype.append((name, fits_dtype))
+        return tforms, numpy.dtype(row_dtype)
+
+    @classmethod
+    def read_output(cls, outfile, names):
+        """Return the state for appending to FITS file ``outfile`` and the date of
+        its last row"""
+        fileobj = open(outfile, 'rb')
+        cards = {}
+        offset = 0
+        for hdu in range(2):
+            end = False
+            while not end:
+                block = fileobj.read(2880)
+                if len(block) < 2880:
+                    raise ValueError('%s is not a fetch FITS file' % outfile)
+                for i in range(0, 2880, 80):
+                    key = block[i:i + 8].strip()
+                    if key == 'END':
+                        end = True
+                        break
+                    if hdu == 1 and block[i + 8:i + 10] == '= ':
+                        value = block[i + 10:i + 80].strip()
+                        if value.startswith("'"):
+                            value = value[1:-1].rstrip().replace("''", "'")
+                        cards[key] = (value, offset + i)
+                offset += 2880
+
+        try:
+            file_names = [cards['TTYPE%d' % (i + 1)][0]
+                          for i in range(int(cards['TFIELDS'][0]))]
+            tforms = [cards['TFORM%d' % (i + 1)][0] for i in range(len(file_names))]
+            n_rows = int(cards['NAXIS2'][0])
+            row_bytes = int(cards['NAXIS1'][0])
+        except (KeyError, ValueError):
+            raise ValueError('%s is not a fetch FITS file' % outfile)
+        if file_names != names:
+            raise ValueError('Columns of %s do not match the fetch columns' % outfile)
+
+        dtypes = [numpy.dtype('S' + x[:-1] if x.endswith('A') else cls.column_dtypes[x])
+                  for x in tforms]
+        last_date = None
+        if n_rows:
+            fileobj.seek(offset + (n_rows - 1) * row_bytes)
+            row = numpy.fromstring(fileobj.read(row_bytes),
+                                   dtype=cls.get_row_dtype(names, dtypes)[1])
+            last_date = row[names[0]][0]
+        fileobj.close()
+
+        state = dict(names=names, dtypes=dtypes,
+                     bytes_written=offset + n_rows * row_bytes, n_rows=n_rows,
+                     naxis2_offset=cards['NAXIS2'][1], data_offset=offset)
+        return state, last_date
+
+    def init_columns(self):
+        self.set_row_dtype()
+        self.write_block([self.card('SIMPLE', True),
+                          self.card('BITPIX', 8),
+                          self.card('NAXIS', 0),
+                          self.card('EXTEND', True)])
+
+        cards = [self.card('XTENSION', 'BINTABLE'),
+                 self.card('BITPIX', 8),
+                 self.card('NAXIS', 2),
+                 self.card('NAXIS1', self.row_dtype.itemsize),
+                 self.card('NAXIS2', 0),
+                 self.card('PCOUNT', 0),
+                 self.card('GCOUNT', 1),
+                 self.card('TFIELDS', len(self.names))]
+        for i, (name, tform) in enumerate(zip(self.names, self.tforms)):
+            cards.append(self.card('TTYPE%d' % (i + 1), name))
+            cards.append(self.card('TFORM%d' % (i + 1), tform))
+        cards.append(self.card('EXTNAME', 'FETCH'))
+        self.naxis2_offset = self.bytes_written + 4 * 80
+        self.write_block(cards)
+        self.data_offset = self.bytes_written
+
+    def checkpoint(self):
+        state = BinaryWriter.checkpoint(self)
+        if self.dtypes is not None:
+            state.update(naxis2_offset=self.naxis2_offset, data_offset=self.data_offset)
+        return state
+
+    def sync(self):
+        sync(self.fileobj)
+
+    def resume(self, state):
+        truncate(self.fileobj, state['bytes_written'])
+        BinaryWriter.resume(self, state)
+        if self.dtypes is not None:
+            self.naxis2_offset = state['naxis2_offset']
+            self.data_offset = state['data_offset']
+
+    def resume_columns(self):
+        self.set_row_dtype()
+
+    def write_arrays(self, arrays):
+        rows = numpy.zeros(len(arrays[0]), dtype=self.row_dtype)
+        for name, tform, values in zip(self.names, self.tforms, arrays):
+            if tform == 'L':
+                rows[name] = numpy.where(values, 'T', 'F')
+            else:
+                rows[name] = values
+        data = rows.tostring()
+        self.fileobj.write(data)
+        self.bytes_written += len(data)
+
+    def close(self):
+        BinaryWriter.close(self)
+        # Pad the data to a whole FITS block and fill in the number of rows
+        padding = -(self.bytes_written - self.data_offset) % 2880
+        self.fileobj.write('\0' * padding)
+        self.bytes_written += padding
+        self.fileobj.seek(self.naxis2_offset)
+        self.fileobj.write(self.card('NAXIS2', self.n_rows))
+        self.fileobj.close()
+
+class NpzWriter(BinaryWriter):
+    """
+    Write a NumPy .npz file with one array per column.  Column data are streamed to
+    temporary files next to the output and assembled into the .npz archive when the
+    file is closed, so memory use does not depend on the number of rows.
+    """
+    @classmethod
+    def read_output(cls, outfile, names):
+        """Return the state for appending to .npz file ``outfile`` and the date of its
+        last row"""
+        try:
+            zipf = zipfile.ZipFile(outfile)
+        except zipfile.BadZipfile:
+            raise ValueError('%s is not a fetch .npz file' % outfile)
+        if sorted(zipf.namelist()) != sorted(name + '.npy' for name in names):
+            raise ValueError('Columns of %s do not match the fetch columns' % outfile)
+        shapes, dtypes = [], []
+        for name in names:
+            fileobj = zipf.open(name + '.npy')
+            numpy.lib.format.read_magic(fileobj)
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(fileobj)
+            shapes.append(shape)
+            dtypes.append(dtype)
+        if len(set(shapes)) != 1:
+            raise ValueError('Columns of %s have different lengths' % outfile)
+        n_rows = shapes[0][0]
+        last_date = None
+        if n_rows:
+            last_date = numpy.lib.format.read_array(zipf.open(names[0] + '.npy'))[-1]
+        zipf.close()
+
+        # The column data are copied out of the archive to append to (see resume())
+        state = dict(names=names, dtypes=dtypes, n_rows=n_rows, extract=True,
+                     bytes_written=n_rows * sum(x.itemsize for x in dtypes))
+        return state, last_date
+
+    def init_columns(self):
+        self.tmpfiles = ['%s.%s.tmp' % (self.outfile, name) for name in self.names]
+        self.fileobjs = [open(x, 'wb') for x in self.tmpfiles]
+
+    def sync(self):
+        for fileobj in getattr(self, 'fileobjs', []):
+            sync(fileobj)
+
+    def resume(self, state):
+        self.extract = state.get('extract', False)
+        BinaryWriter.resume(self, state)
+
+    def resume_columns(self):
+        self.tmpfiles = ['%s.%s.tmp' % (self.outfile, name) for name in self.names]
+        if self.extract:
+            zipf = zipfile.ZipFile(self.outfile)
+            for name, tmpfile in zip(self.names, self.tmpfiles):
+                fileobj = zipf.open(name + '.npy')
+                numpy.lib.format.read_magic(fileobj)
+                numpy.lib.format.read_array_header_1_0(fileobj)
+                with open(tmpfile, 'wb') as fout:
+                    shutil.copyfileobj(fileobj, fout, 1 << 20)
+            zipf.close()
+        self.fileobjs = [open(x, 'r+b') for x in self.tmpfiles]
+        for fileobj, dtype in zip(self.fileobjs, self.dtypes):
+            truncate(fileobj, self.n_rows * dtype.itemsize)
+
+    def write_arrays(self, arrays):
+        for fileobj, values in zip(self.fileobjs, arrays):
+            data = numpy.ascontiguousarray(values).tostring()
+            fileobj.write(data)
+            self.bytes_written += len(data)
+
+    def close(self):
+        BinaryWriter.close(self)
+        zipf = zipfile.ZipFile(self.outfile, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        for name, dtype, fileobj, tmpfile in zip(self.names, self.dtypes,
+                                                 self.fileobjs, self.tmpfiles):
+            fileobj.close()
+            npyfile = tmpfile + '.npy'
+            with open(npyfile, 'wb') as fout:
+                numpy.lib.format.write_array_header_1_0(
+                    fout, {'descr': numpy.lib.format.dtype_to_descr(dtype),
+                           'fortran_order': False,
+                           'shape': (self.n_rows,)})
+                with open(tmpfile, 'rb') as fin:
+                    shutil.copyfileobj(fin, fout, 1 << 20)
+            zipf.write(npyfile, name + '.npy')
+            os.unlink(npyfile)
+            os.unlink(tmpfile)
+        zipf.close()
+
+class Hdf5Writer(BinaryWriter):
+    """
+    Write an HDF5 file with one resizable dataset per column (requires h5py).
+    """
+    def __init__(self, outfile, append=False):
+        import h5py
+        BinaryWriter.__init__(self, outfile, append)
+        self.h5file = h5py.File(outfile, 'r+' if append else 'w')
+
+    @classmethod
+    def read_output(cls, outfile, names):
+        """Return the state for appending to HDF5 file ``outfile`` and the date of its
+        last row"""
+        import h5py
+        try:
+            h5file = h5py.File(outfile, 'r')
+        except IOError:
+            raise ValueError('%s is not a fetch HDF5 file' % outfile)
+        if sorted(h5file.keys()) != sorted(names):
+            raise ValueError('Columns of %s do not match the fetch columns' % outfile)
+        datasets = [h5file[name] for name in names]
+        n_rows = len(datasets[0])
+        if any(len(x) != n_rows for x in datasets):
+            raise ValueError('Columns of %s have different lengths' % outfile)
+        dtypes = [x.dtype for x in datasets]
+        last_date = datasets[0][n_rows - 1] if n_rows else None
+        h5file.close()
+
+        state = dict(names=names, dtypes=dtypes, n_rows=n_rows,
+                     bytes_written=n_rows * sum(x.itemsize for x in dtypes))
+        return state, last_date
+
+    def init_columns(self):
+        self.datasets = [self.h5file.create_dataset(name, shape=(0,), dtype=dtype,
+                                                    maxshape=(None,), chunks=True)
+                         for name, dtype in zip(self.names, self.dtypes)]
+
+    def write_arrays(self, arrays):
+        n_rows = len(arrays[0])
+        for dataset, values in zip(self.datasets, arrays):
+            dataset.resize((self.n_rows + n_rows,))
+            dataset[self.n_rows:] = values
+            self.bytes_written += values.nbytes
+
+    def sync(self):
+        self.h5file.flush()
+
+    def resume(self, state):
+        BinaryWriter.resume(self, state)
+        if self.dtypes is None:
+            # Checkpointed before the first rows: drop any datasets created since
+            for name in list(self.h5file):
+                del self.h5file[name]
+
+    def resume_columns(self):
+        self.datasets = [self.h5file[name] for name in self.names]
+        for dataset in self.datasets:
+            if len(dataset) < self.n_rows:
+                raise ValueError('Output file %s is shorter than at the checkpoint'
+                                 % self.outfile)
+            dataset.resize((self.n_rows,))
+
+    def close(self):
+        BinaryWriter.close(self)
+        self.h5file.close()
+
+binary_writers = {'fits': FitsWriter,
+                  'npz': NpzWriter,
+                  'hdf5': Hdf5Writer}
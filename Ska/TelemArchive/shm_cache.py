@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+Share decoded day tables between fetch processes on the same host.
+
+Columns decoded from a SKA_DATA/YYYY/DOY/<table_type>.fits.gz file are published
+as a segment directory SHM_DIR/YYYY_DOY_<table_type>/ on a tmpfs (/dev/shm by
+default) holding one ``.npy`` file per column plus a ``header.pkl`` like the
+column store.  Any fetch process on the host attaches to the segment by
+memory-mapping the column files read-only, so there is one copy of each decoded
+table in RAM however many processes use it.
+
+Each process that has a segment attached holds a reference, which is an empty
+file SHM_DIR/YYYY_DOY_<table_type>/refs/<pid>.  Once the total size of the
+segments exceeds the cap, the least recently attached segments that have no
+references are evicted.  References of processes that no longer exist (e.g. a
+crashed fetch) are dropped, along with any partly published segments they left,
+during eviction or by running this module with --clean.
+
+The cache is off unless TELEM_ARCHIVE_SHM_MB is set to the size cap in MB (or
+set_max_bytes() is called, e.g. by fetch_server --shm-cache-mb).
+"""
+__docformat__ = 'restructuredtext'
+import os
+import sys
+import re
+import errno
+import shutil
+import atexit
+import logging
+import cPickle
+import threading
+import numpy
+
+from Ska.TelemArchive import column_store
+from Ska.TelemArchive.fetch_stats import stats
+
+SHM_DIR = os.getenv('TELEM_ARCHIVE_SHM_DIR') or '/dev/shm/telem_archive-%d' % os.getuid()
+
+logger = logging.getLogger('data_table')
+
+def main():
+    (opt, args) = get_options()
+    cache = SharedTableCache(opt.shm_dir,
+                             max_bytes=int(opt.max_mb * 1024**2) if opt.max_mb else sys.maxint)
+    if opt.clear:
+        cache.max_bytes = 0
+    if opt.clean or opt.clear:
+        cache.clean()
+    segments = cache.get_segments()
+    print 'Shared table cache %s: %d segments, %.1f MB (%d referenced)' % (
+        cache.root, len(segments), sum(x['nbytes'] for x in segments) / 1024.**2,
+        len([x for x in segments if x['refs']]))
+
+def segment_name(year, doy, table_type):
+    return '%04d_%03d_%s' % (year, doy, table_type)
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        return err.errno != errno.ESRCH
+    return True
+
+class SharedTableCache(object):
+    """
+    Day table columns published in shared memory and attached read-only by any
+    fetch process on the host.  Segments total at most ``max_bytes`` bytes apart
+    from ones that are all still referenced.
+    """
+    def __init__(self, root, max_bytes=0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.pid = os.getpid()
+        self.held = set()          # Segments referenced by this process
+        self.lock = threading.RLock()
+
+    def _check_fork(self):
+        # A forked child does not own the references of its parent
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.held = set()
+
+    def _enabled(self):
+        return self.max_bytes > 0
+
+    enabled = property(_enabled)
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+
+    def segment_dir(self, year, doy, table_type):
+        return os.path.join(self.root, segment_name(year, doy, table_type))
+
+    def attach(self, year, doy, table_type):
+        """Add a reference from this process to the year, doy, table_type segment.
+        Return its header dict, or None if there is no current segment for the day
+        file."""
+        name = segment_name(year, doy, table_type)
+        segdir = os.path.join(self.root, name)
+        try:
+            header = cPickle.load(open(os.path.join(segdir, 'header.pkl'), 'rb'))
+            src_mtime = os.stat(column_store.fits_file(year, doy, table_type)).st_mtime
+        except (IOError, OSError, EOFError):
+            return None
+        if header['src_mtime'] != src_mtime:
+            # Day file changed since the segment was published
+            self._remove(name)
+            return None
+        if not self._add_ref(name):
+            return None
+        os.utime(os.path.join(segdir, 'header.pkl'), None)
+        stats.count('shm_attached')
+        return header
+
+    def read_columns(self, year, doy, table_type, col_names):
+        """Return dict of read-only memory-mapped arrays for each of ``col_names``
+        that is in the segment"""
+        segdir = self.segment_dir(year, doy, table_type)
+        columns = {}
+        for col_name in col_names:
+            try:
+                arr = numpy.load(os.path.join(segdir, col_name + '.npy'), mmap_mode='r')
+            except (IOError, OSError):
+                continue
+            if arr.dtype.kind == 'S':
+                arr = arr.view(numpy.chararray)
+            columns[col_name] = arr
+        return columns
+
+    def publish(self, year, doy, table_type, header, columns):
+        """Add dict of ``columns`` arrays to the segment for year, doy, table_type,
+        creating it with ``header`` if needed, and reference the segment.  Return the
+        columns as arrays mapped from the segment, or ``columns`` unchanged if there
+        is no room within max_bytes."""
+        self._check_fork()
+        name = segment_name(year, doy, table_type)
+        segdir = os.path.join(self.root, name)
+        nbytes = sum(x.nbytes for x in columns.values())
+        if not self.clean(nbytes):
+            logger.debug('No room in shared table cache for %s' % name)
+            return columns
+
+        try:
+            if not os.path.exists(segdir):
+                self._create(name, header)
+            if not self._add_ref(name):
+                return columns
+            for col_name, arr in columns.items():
+                filename = os.path.join(segdir, col_name + '.npy')
+                if not os.path.exists(filename):
+                    # Write then rename so other processes never map a partial column
+                    tmpfile = '%s.tmp%d' % (filename, self.pid)
+                    numpy.save(open(tmpfile, 'wb'), numpy.asarray(arr))
+                    os.rename(tmpfile, filename)
+        except (IOError, OSError), msg:
+            logger.warning('Could not publish %s in shared table cache: %s' % (name, msg))
+            return columns
+
+        stats.count('shm_published')
+        logger.debug('Published %s in shared table cache' % name)
+        shared = self.read_columns(year, doy, table_type, columns.keys())
+        return dict((x, shared.get(x, columns[x])) for x in columns)
+
+    def _create(self, name, header):
+        tmpdir = os.path.join(self.root, '.%s.tmp%d' % (name, self.pid))
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+        os.makedirs(os.path.join(tmpdir, 'refs'))
+        cPickle.dump(header, open(os.path.join(tmpdir, 'header.pkl'), 'wb'), -1)
+        try:
+            os.rename(tmpdir, os.path.join(self.root, name))
+        except OSError:
+            # Another process published the segment in the meantime
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _add_ref(self, name):
+        with self.lock:
+            self._check_fork()
+            if name in self.held:
+                return True
+            try:
+                open(os.path.join(self.root, name, 'refs', str(self.pid)), 'w').close()
+            except IOError:
+                # Segment was evicted
+                return False
+            self.held.add(name)
+            return True
+
+    def release(self, year, doy, table_type):
+        """Drop the reference from this process to a segment"""
+        self._release(segment_name(year, doy, table_type))
+
+    def _release(self, name):
+        with self.lock:
+            self._check_fork()
+            if name not in self.held:
+                return
+            self.held.discard(name)
+            try:
+                os.unlink(os.path.join(self.root, name, 'refs', str(self.pid)))
+            except OSError:
+                pass
+
+    def release_all(self):
+        for name in list(self.held):
+            self._release(name)
+
+    def _remove(self, name):
+        """Remove a segment.  Processes that have its columns mapped keep them until
+        they drop the table."""
+        trash = os.path.join(self.root, '.%s.del%d' % (name, self.pid))
+        try:
+            os.rename(os.path.join(self.root, name), trash)
+        except OSError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def get_segments(self):
+        """Return list of dicts with the name, size, last attach time and live
+        references of each segment.  References of processes that no longer exist
+        are dropped."""
+        segments = []
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return segments
+        for name in names:
+            if name.startswith('.'):
+                continue
+            segdir = os.path.join(self.root, name)
+            try:
+                refs = []
+                for ref in os.listdir(os.path.join(segdir, 'refs')):
+                    if pid_exists(int(ref)):
+                        refs.append(int(ref))
+                    else:
+                        os.unlink(os.path.join(segdir, 'refs', ref))
+                nbytes = 0
+                for filename in os.listdir(segdir):
+                    match = re.match(r'.+\.npy\.tmp(\d+)$', filename)
+                    if match and not pid_exists(int(match.group(1))):
+                        os.unlink(os.path.join(segdir, filename))
+                    elif filename.endswith('.npy'):
+                        nbytes += os.path.getsize(os.path.join(segdir, filename))
+                last_used = os.path.getmtime(os.path.join(segdir, 'header.pkl'))
+            except (OSError, ValueError):
+                continue
+            segments.append(dict(name=name, nbytes=nbytes, last_used=last_used, refs=refs))
+        return segments
+
+    def clean(self, nbytes=0):
+        """Remove segments left partly published or partly removed by processes that
+        no longer exist, then evict unreferenced segments in least recently attached
+        order until ``nbytes`` more bytes fit within max_bytes.  Return True if they
+        fit."""
+        with self.lock:
+            try:
+                names = os.listdir(self.root)
+            except OSError:
+                try:
+                    os.makedirs(self.root)
+                except OSError:
+                    return False
+                names = []
+            for name in names:
+                match = re.match(r'\.(.+)\.(tmp|del)(\d+)$', name)
+                if match and not pid_exists(int(match.group(3))):
+                    logger.debug('Removing orphaned shared table cache segment %s' % name)
+                    shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+            segments = self.get_segments()
+            total = sum(x['nbytes'] for x in segments)
+            for segment in sorted(segments, key=lambda x: x['last_used']):
+                if total + nbytes <= self.max_bytes:
+                    break
+                if not segment['refs']:
+                    logger.debug('Evicting %s from shared table cache' % segment['name'])
+                    self._remove(segment['name'])
+                    stats.count('shm_evicted')
+                    total -= segment['nbytes']
+            return total + nbytes <= self.max_bytes
+
+shm_cache = SharedTableCache(SHM_DIR, max_bytes=int(float(os.getenv('TELEM_ARCHIVE_SHM_MB') or 0)
+                                                    * 1024**2))
+atexit.register(shm_cache.release_all)
+
+def get_options():
+    from optparse import OptionParser
+    parser = OptionParser(usage='shm_cache.py [options]')
+    parser.set_defaults()
+    parser.add_option("--shm-dir",
+                      default=SHM_DIR,
+                      help="Shared table cache directory",
+                      )
+    parser.add_option("--max-mb",
+                      type='float',
+                      default=float(os.getenv('TELEM_ARCHIVE_SHM_MB') or 0),
+                      help="Size cap (MB) to evict down to with --clean (default = no cap)",
+                      )
+    parser.add_option("--clean",
+                      action="store_true",
+                      default=False,
+                      help="Remove orphaned segments and evict down to the size cap",
+                      )
+    parser.add_option("--clear",
+                      action="store_true",
+                      default=False,
+                      help="Remove all segments that are not referenced",
+                      )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Compiled catalog of the telemetry archive table definitions.
+
+The table definitions are YAML files SKA_DATA/tables/<table_name>.yml.  Parsing
+them is slow compared to the rest of setting up a fetch, so the compiled catalog
+(table definitions, output columns of each table and the tables containing each
+column name) is cached in memory and in a pickle next to the tables directory.
+The cache is rebuilt whenever the set of definition files or their modification
+times change.
+"""
+__docformat__ = 'restructuredtext'
+import os
+import re
+import logging
+import cPickle
+from glob import glob
+
+SKA = os.getenv('SKA') or '/proj/sot/ska'
+SKA_DATA = SKA + '/data/telem_archive'
+TABLE_DIR = SKA_DATA + '/tables'
+
+logger = logging.getLogger('data_table')
+
+# Bump when TableCatalog changes so existing catalog files are rebuilt
+CATALOG_VERSION = 1
+
+# Compiled catalogs in this process by table directory
+catalogs = {}
+
+class InvalidTableOrColumn(LookupError):
+    """Custom exception if no matching table or column is found"""
+
+class TableCatalog(object):
+    """
+    Table definitions along with the precomputed output column names for each table
+    and the reverse map of column name to the tables that provide it.
+    """
+    def __init__(self, table_defs, mtimes):
+        self.version = CATALOG_VERSION
+        self.table_defs = table_defs
+        self.mtimes = mtimes
+        self.output_cols = {}
+        self.col_tables = {}
+        for table_name, table_def in table_defs.items():
+            table_columns = table_def['columns']
+            skip_cols = ['time', 'quality']
+            skip_cols += [x['name'] for x in table_columns if not x.get('is_output', True)]
+            self.output_cols[table_name] = [x['name'] for x in table_columns
+                                            if x['name'] not in skip_cols]
+            for col_name in self.output_cols[table_name]:
+                self.col_tables.setdefault(col_name, []).append(table_name)
+
+    def get_table_columns(self, table_name, col_names=None):
+        """Return list of column definition dicts for ``col_names`` (default all output
+        columns) in ``table_name``"""
+        if table_name not in self.table_defs:
+            raise InvalidTableOrColumn, "No table named %s" % table_name
+
+        table_col_names = self.output_cols[table_name]
+        if not col_names:
+            col_names = table_col_names
+
+        columns = []
+        for col_name in col_names:
+            if col_name not in table_col_names:
+                raise InvalidTableOrColumn, \
+                      "No column %s in %s table" % (col_name, table_name)
+            columns.append({'table': table_name,
+                            'name' : col_name})
+        return columns
+
+    def find_column(self, col_name):
+        """Return the column definition dict for ``col_name`` in whichever table has it"""
+        table_names = self.col_tables.get(col_name)
+        if not table_names:
+            raise InvalidTableOrColumn('Column %s not found in any table' % col_name)
+        return {'table': table_names[0],
+                'name' : col_name}
+
+def catalog_file(table_dir):
+    return os.path.join(os.path.dirname(os.path.abspath(table_dir)), 'table_catalog.pkl')
+
+def get_catalog(table_dir=TABLE_DIR):
+    """Return the TableCatalog for the table definition files in ``table_dir``"""
+    table_files = glob(table_dir + '/*.yml')
+    assert table_files, 'No table files found'
+    mtimes = dict((x, os.stat(x).st_mtime) for x in table_files)
+
+    catalog = catalogs.get(table_dir)
+    if catalog is not None and catalog.mtimes == mtimes:
+        return catalog
+
+    try:
+        catalog = cPickle.load(open(catalog_file(table_dir), 'rb'))
+        if catalog.version != CATALOG_VERSION or catalog.mtimes != mtimes:
+            catalog = None
+    except Exception:
+        catalog = None
+
+    if catalog is None:
+        catalog = TableCatalog(read_table_defs(table_files), mtimes)
+        write_catalog(catalog, catalog_file(table_dir))
+
+    catalogs[table_dir] = catalog
+    return catalog
+
+def read_table_defs(table_files):
+    """Read the table definition ``table_files``.  Return dict of table definitions
+    by table name."""
+    import yaml
+    table_defs = {}
+    for filename in table_files:
+        table_name = re.sub(r'\.yml$', '', os.path.basename(filename))
+        table_defs[table_name] = yaml.load(open(filename).read())
+    return table_defs
+
+def write_catalog(catalog, filename):
+    """Write ``catalog`` to ``filename`` if possible.  The file is written under a
+    temporary name and renamed into place so readers never see a partial file."""
+    tmpfile = '%s.tmp%d' % (filename, os.getpid())
+    try:
+        cPickle.dump(catalog, open(tmpfile, 'wb'), -1)
+        os.rename(tmpfile, filename)
+    except (IOError, OSError), msg:
+        logger.debug('Could not write table catalog %s: %s' % (filename, msg))
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
@@ -0,0 +1,209 @@
+"""
+Convert arrays of Chandra seconds to the fetch output time formats in bulk.
+
+Within one day every time format is a simple function of the seconds since the
+start of the day, so one Chandra.Time conversion per day anchors the day and the
+rest is numpy arithmetic.  UTC formats (date, greta, jd, mjd, unix) are anchored
+on UTC days, with days containing a leap second converted element by element.
+The fits format is TT, where every day is 86400 sec from the 1998.0 epoch of
+Chandra seconds.  Values that fall too close to a rounding boundary to be sure of
+matching Chandra.Time exactly are converted element by element.
+"""
+__docformat__ = 'restructuredtext'
+import logging
+import datetime
+import numpy
+
+from Ska.TelemArchive.data_table import add_days, date_to_day, day_start
+
+logger = logging.getLogger('data_table')
+
+DAY_SECS = 86400.0
+TT_EPOCH = datetime.date(1998, 1, 1)
+
+# Fraction of the last output digit within which a value is considered to be at a
+# rounding tie and is converted by Chandra.Time instead
+TIE_TOL = 0.01
+
+def convert_times(secs, time_format):
+    """Return ``secs`` (array of Chandra secs) converted to ``time_format``.
+
+    :param secs: array of Chandra secs in increasing order
+    :param time_format: any Chandra.Time.DateTime format attribute name
+
+    :rtype: numpy string array for date, greta and fits, otherwise float array
+    """
+    secs = numpy.asarray(secs, dtype=numpy.float64)
+    if time_format == 'secs':
+        return secs
+    import Chandra.Time
+    if (time_format not in ('date', 'greta', 'fits', 'jd', 'mjd', 'unix')
+        or len(secs) < 2 or numpy.any(numpy.diff(secs) < 0)):
+        return convert_each(secs, time_format)
+
+    # Anchoring each day costs a few Chandra.Time calls, so sparse samples are
+    # faster to convert one by one
+    if (secs[-1] - secs[0]) / DAY_SECS * 64 > len(secs):
+        return convert_each(secs, time_format)
+
+    if time_format == 'fits':
+        out, ok = convert_tt(secs)
+    else:
+        out, ok = convert_utc(secs, time_format)
+
+    for i in numpy.flatnonzero(~ok):
+        out[i] = getattr(Chandra.Time.DateTime(secs[i]), time_format)
+
+    # Spot check the output strings against Chandra.Time in case of any difference
+    # in conventions
+    for i in (0, len(secs) // 2, len(secs) - 1):
+        if str(out[i].item()) != str(getattr(Chandra.Time.DateTime(secs[i]), time_format)):
+            logger.debug('Bulk %s time conversion mismatch at %s, converting each time'
+                         % (time_format, secs[i]))
+            return convert_each(secs, time_format)
+    return out
+
+def convert_each(secs, time_format):
+    """Convert ``secs`` to ``time_format`` with one Chandra.Time call per element"""
+    import Chandra.Time
+    return numpy.array([getattr(Chandra.Time.DateTime(x), time_format)
+                        for x in secs.tolist()])
+
+def parse_time(value, time_format):
+    """Return the Chandra secs of time stamp ``value`` in ``time_format`` as read back
+    from fetch output (a string for text output).  The result is only as precise as
+    the format."""
+    if isinstance(value, basestring):
+        value = value.strip()
+    if time_format == 'secs':
+        return float(value)
+    import Chandra.Time
+    if time_format in ('jd', 'mjd', 'unix'):
+        value = float(value)
+    return Chandra.Time.DateTime(value, format=time_format).secs
+
+def time_precision(value, time_format):
+    """Return the precision (secs) of time stamp ``value`` in ``time_format`` as read
+    back from fetch output.  Date strings have milliseconds, numbers written as text
+    have the 12 significant digits of str() and binary numbers are exact for secs and
+    good to a few units of float rounding otherwise."""
+    if time_format in ('date', 'greta', 'fits'):
+        return 0.001
+    scale = DAY_SECS if time_format in ('jd', 'mjd') else 1.0
+    if isinstance(value, basestring):
+        value = abs(float(value))
+        return scale * 10.0 ** (numpy.floor(numpy.log10(value)) - 11) if value else 0.0
+    if time_format == 'secs':
+        return 0.0
+    return scale * 8 * numpy.spacing(abs(float(value)))
+
+def convert_utc(secs, time_format):
+    """Convert ``secs`` to a UTC-based ``time_format`` one UTC day at a time.
+
+    :rtype: out, ok = converted array, bool array that is False where the value
+            must still be converted with Chandra.Time
+    """
+    import Chandra.Time
+    if time_format in ('date', 'greta'):
+        out = numpy.zeros(len(secs), dtype='S%d' % (21 if time_format == 'date' else 17))
+    else:
+        out = numpy.zeros(len(secs), dtype=numpy.float64)
+    ok = numpy.ones(len(secs), dtype=bool)
+
+    i0 = 0
+    while i0 < len(secs):
+        year, doy = date_to_day(secs[i0])
+        tstart = day_start(year, doy)
+        if secs[i0] < tstart:
+            # Rounded up to the next day in the date string
+            year, doy = add_days(year, doy, -1)
+            tstart = day_start(year, doy)
+        tstop = day_start(*add_days(year, doy, 1))
+        i1 = max(numpy.searchsorted(secs, tstop), i0 + 1)
+        day = slice(i0, i1)
+
+        if tstop - tstart != DAY_SECS:
+            # Leap second day
+            ok[day] = False
+        elif time_format in ('date', 'greta'):
+            if time_format == 'date':
+                prefix = '%04d:%03d:' % (year, doy)
+            else:
+                prefix = '%04d%03d.' % (year, doy)
+            out[day], ok[day] = format_day(secs[day] - tstart, prefix, time_format)
+        else:
+            values = getattr(Chandra.Time.DateTime(tstart), time_format)
+            if time_format == 'unix':
+                values = values + (secs[day] - tstart)
+            else:
+                values = values + (secs[day] - tstart) / DAY_SECS
+            out[day] = values
+            ok[day] = ~near_str_tie(values)
+        i0 = i1
+
+    return out, ok
+
+def convert_tt(secs):
+    """Convert ``secs`` to the TT-based fits format one day at a time.
+
+    :rtype: out, ok (see convert_utc())
+    """
+    out = numpy.zeros(len(secs), dtype='S23')
+    ok = numpy.ones(len(secs), dtype=bool)
+    days = numpy.floor(secs / DAY_SECS).astype(numpy.int64)
+    i_starts = numpy.flatnonzero(numpy.diff(days)) + 1
+    for i0, i1 in zip(numpy.concatenate([[0], i_starts]),
+                      numpy.concatenate([i_starts, [len(secs)]])):
+        day = slice(i0, i1)
+        date = TT_EPOCH + datetime.timedelta(days=int(days[i0]))
+        prefix = date.strftime('%Y-%m-%dT')
+        out[day], ok[day] = format_day(secs[day] - days[i0] * DAY_SECS, prefix, 'fits')
+    return out, ok
+
+def format_day(day_secs, prefix, time_format):
+    """Format times of day ``day_secs`` (sec since start of day) as date, greta or
+    fits strings following ``prefix`` (the part of the string giving the day).
+
+    :rtype: strings, ok
+    """
+    msecs = day_secs * 1000.0
+    ok = numpy.abs(msecs - numpy.floor(msecs) - 0.5) > TIE_TOL
+    msecs = numpy.round(msecs).astype(numpy.int64)
+    # Times that round up to the start of the next day
+    ok &= msecs < DAY_SECS * 1000
+    msecs = numpy.minimum(msecs, int(DAY_SECS * 1000) - 1)
+
+    secs, msec = divmod(msecs, 1000)
+    mins, sec = divmod(secs, 60)
+    hour, mins = divmod(mins, 60)
+    if time_format == 'greta':
+        fields = [prefix, (hour, 2), (mins, 2), (sec, 2), (msec, 3)]
+    else:
+        fields = [prefix, (hour, 2), ':', (mins, 2), ':', (sec, 2), '.', (msec, 3)]
+    return build_strings(len(msecs), fields), ok
+
+def build_strings(n_rows, fields):
+    """Build an array of ``n_rows`` fixed width strings from ``fields``, which are
+    either literal strings or (int array, width) for zero-padded integers"""
+    width = sum(len(x) if isinstance(x, str) else x[1] for x in fields)
+    chars = numpy.empty((n_rows, width), dtype=numpy.uint8)
+    i = 0
+    for field in fields:
+        if isinstance(field, str):
+            chars[:, i:i + len(field)] = numpy.fromstring(field, dtype=numpy.uint8)
+            i += len(field)
+        else:
+            values, n_digits = field
+            for j in range(n_digits):
+                chars[:, i + j] = values // 10 ** (n_digits - 1 - j) % 10 + ord('0')
+            i += n_digits
+    return chars.view('S%d' % width).ravel()
+
+def near_str_tie(values):
+    """Return bool array that is True where str() of float ``values`` (12 significant
+    digits) is close to a rounding tie in the last digit"""
+    absvals = numpy.abs(values)
+    absvals[absvals == 0] = 1.0
+    scale = 10.0 ** (11 - numpy.floor(numpy.log10(absvals)))
+    digits = absvals * scale
+    return numpy.abs(digits - numpy.floor(digits) - 0.5) <= TIE_TOL
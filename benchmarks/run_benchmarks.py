@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Run fetch benchmark scenarios against a synthetic archive and report JSON.
+
+Each scenario runs in a fresh python process with SKA set to the synthetic
+archive root so that peak RSS and import time are measured per scenario.  The
+report gives rows/s, MB/s of output, peak RSS and the time of each stage for every
+scenario (with the fetch stage timers and counters from ``--profile``), along with
+the git commit, so reports can be compared across commits.
+
+Example::
+
+  python benchmarks/run_benchmarks.py --root /tmp/bench_ska --outfile bench.json
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import tempfile
+import resource
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ('day_1col', 'month_many_cols', 'dt_1s', 'obsid', 'server_roundtrip')
+
+def main():
+    (opt, args) = get_options()
+    if opt.run:
+        print json.dumps(run_scenario(opt.run))
+        return
+
+    root = os.path.abspath(opt.root)
+    if opt.make_archive or not os.path.exists(os.path.join(root, 'data', 'telem_archive')):
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import synth_archive
+        print >>sys.stderr, 'Making synthetic archive in %s' % root
+        synth_archive.make_archive(root, n_days=opt.days)
+
+    env = dict(os.environ)
+    env['SKA'] = root
+    env['PYTHONPATH'] = os.pathsep.join([REPO] + [x for x in [env.get('PYTHONPATH')] if x])
+
+    results = {}
+    for name in (args or SCENARIOS):
+        if name not in SCENARIOS:
+            raise ValueError('Unknown scenario %s (choose from %s)' % (name, ' '.join(SCENARIOS)))
+        print >>sys.stderr, 'Running %s' % name
+        output = subprocess.check_output([opt.python, os.path.abspath(__file__),
+                                          '--run', name], env=env)
+        results[name] = json.loads(output.splitlines()[-1])
+
+    report = dict(commit=git_commit(),
+                  python=subprocess.check_output([opt.python, '-c',
+                                                  'import platform; print platform.python_version()'],
+                                                 env=env).splitlines()[-1],
+                  time=time.ctime(),
+                  root=root,
+                  scenarios=results)
+    out = open(opt.outfile, 'w') if opt.outfile else sys.stdout
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_scenario_kwargs(name):
+    """Return fetch() keyword args for scenario ``name`` based on the days and
+    observations in the archive at $SKA"""
+    import sqlite3
+    from Ska.TelemArchive import column_store
+    from Ska.TelemArchive.data_table import add_days, day_start
+
+    # Start at the second day of the archive
+    year, doy = column_store.get_day_files()[0][:2]
+    tstart = day_start(*add_days(year, doy, 1))
+
+    if name == 'day_1col':
+        return dict(start=tstart, stop=tstart + 86400, colspecs=['tephin'])
+    elif name == 'month_many_cols':
+        return dict(start=tstart, stop=tstart + 30 * 86400,
+                    colspecs=['ephin2eng:', 'acis2eng:'])
+    elif name == 'dt_1s':
+        return dict(start=tstart, stop=tstart + 86400, dt=1.0,
+                    colspecs=['pcad8eng:aoattqt1,aoattqt2,aoattqt3,aoattqt4', 'tephin'])
+    elif name in ('obsid', 'server_roundtrip'):
+        conn = sqlite3.connect(os.path.join(column_store.SKA_DATA, 'db.sql3'))
+        obsid = conn.execute('SELECT obsid FROM observations '
+                             'ORDER BY kalman_tstop - kalman_tstart DESC').fetchone()[0]
+        conn.close()
+        return dict(obsid=obsid, colspecs=['acis2eng:', 'pcad8eng:aoattqt1,aoattqt2'])
+
+def run_scenario(name):
+    """Run one scenario in this process and return a dict of results"""
+    workdir = tempfile.mkdtemp()
+    outfile = os.path.join(workdir, 'telem.dat')
+    stages = {}
+    profile = None
+    try:
+        t0 = time.time()
+        import Ska.TelemArchive.fetch as fetch
+        stages['import'] = time.time() - t0
+
+        kwargs = get_scenario_kwargs(name)
+        if name == 'server_roundtrip':
+            outfile = run_server_roundtrip(kwargs, workdir, stages)
+        else:
+            t0 = time.time()
+            fetch.get_fetch_columns(kwargs['colspecs'])
+            stages['columns'] = time.time() - t0
+
+            t0 = time.time()
+            fetch.fetch(outfile=outfile, out_format='csv', profile=True, **kwargs)
+            stages['fetch'] = time.time() - t0
+            profile = fetch.stats.as_dict()
+
+        n_rows = sum(1 for line in open(outfile)) - 1
+        n_bytes = os.path.getsize(outfile)
+    finally:
+        shutil.rmtree(workdir)
+
+    seconds = stages.get('fetch', stages.get('run'))
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return dict(rows=n_rows,
+                bytes=n_bytes,
+                seconds=seconds,
+                rows_per_sec=n_rows / seconds,
+                mb_per_sec=n_bytes / 1e6 / seconds,
+                peak_rss_mb=peak_rss / 1024.,
+                stages=stages,
+                profile=profile)
+
+def run_server_roundtrip(kwargs, workdir, stages):
+    """Start a fetch server, submit a fetch, wait for it to finish and stop the
+    server.  Return the fetch output file."""
+    import signal
+    from Ska.TelemArchive import fetch_client
+
+    # Pick a free port
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    outroot = os.path.join(workdir, 'server')
+    os.makedirs(outroot)
+    server_py = os.path.join(REPO, 'Ska', 'TelemArchive', 'fetch_server.py')
+    t0 = time.time()
+    server = subprocess.Popen([sys.executable, server_py, '--port', str(port),
+                               '--outroot', outroot,
+                               '--logfile', os.path.join(workdir, 'server.log')])
+    signal.signal(signal.SIGALRM, fetch_client.timeout_handler)
+    try:
+        # Wait for the server to answer a status request
+        while 'client_error' in str(fetch_client.send(dict(cmd='get_status'),
+                                                      host='localhost', port=port)):
+            if time.time() - t0 > 30:
+                raise RuntimeError('Fetch server did not start')
+            time.sleep(0.02)
+        stages['server_start'] = time.time() - t0
+
+        t0 = time.time()
+        kwargs = dict(kwargs, out_format='csv')
+        jobs = fetch_client.send(dict(cmd='run_fetch', kwargs=kwargs), host='localhost', port=port)
+        job = jobs[0]
+        if 'jobid' not in job:
+            raise RuntimeError('Fetch server error: %s' % job)
+        stages['submit'] = time.time() - t0
+
+        while job.get('status') not in ('done', 'error'):
+            time.sleep(0.02)
+            jobs = fetch_client.send(dict(cmd='get_status'), host='localhost', port=port)
+            job = [x for x in jobs if x.get('jobid') == job['jobid']][0]
+        stages['run'] = time.time() - t0
+        if job['status'] == 'error':
+            raise RuntimeError('Fetch job failed: %s' % job.get('error'))
+    finally:
+        fetch_client.send(dict(cmd='stop_server'), host='localhost', port=port)
+        server.wait()
+
+    return job['outfile']
+
+def get_options():
+    from optparse import OptionParser, SUPPRESS_HELP
+    parser = OptionParser(usage='run_benchmarks.py [options] [scenario1 ...]')
+    parser.set_defaults()
+    parser.add_option("--root",
+                      default='bench_ska',
+                      help="Root of the synthetic archive (used as $SKA)",
+                      )
+    parser.add_option("--make-archive",
+                      action="store_true",
+                      default=False,
+                      help="Make the synthetic archive even if it already exists",
+                      )
+    parser.add_option("--days",
+                      type='int',
+                      default=35,
+                      help="Number of days if making the synthetic archive",
+                      )
+    parser.add_option("--python",
+                      default=sys.executable,
+                      help="Python interpreter to run the scenarios (default = this one)",
+                      )
+    parser.add_option("--outfile",
+                      help="JSON report file (default = stdout)",
+                      )
+    # Internal: run one scenario and print the results as JSON
+    parser.add_option("--run",
+                      help=SUPPRESS_HELP,
+                      )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
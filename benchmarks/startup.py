@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Check the fetch startup time against a budget.
+
+Times ``fetch.py --help`` and a one hour fetch in fresh python processes (best of
+--repeat runs) and checks that importing Ska.TelemArchive.fetch does not load any
+of the heavy modules that are only needed by particular features.  Exits with
+status 1 if any budget is exceeded.
+
+Example::
+
+  python benchmarks/startup.py --start 2008:081:12:00:00 tephin
+"""
+import os
+import sys
+import time
+import subprocess
+
+# Modules that must not be loaded just by importing Ska.TelemArchive.fetch
+HEAVY_MODULES = ('pyfits', 'yaml', 'sqlite3', 'pyparsing', 'mx', 'Chandra.Time',
+                 'multiprocessing', 'h5py')
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FETCH = os.path.join(REPO, 'Ska', 'TelemArchive', 'fetch.py')
+
+def main():
+    (opt, args) = get_options()
+    colspecs = args or ['ephin2eng:']
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([REPO] + [x for x in [env.get('PYTHONPATH')] if x])
+
+    failed = False
+
+    cmd = [opt.python, '-c', 'import sys, Ska.TelemArchive.fetch; '
+           'print " ".join(x for x in %r if x in sys.modules)' % (HEAVY_MODULES,)]
+    lines = subprocess.check_output(cmd, env=env).splitlines()
+    loaded = lines[-1].split() if lines else []
+    print 'Heavy modules loaded on import: %s' % (' '.join(loaded) or 'none')
+    failed |= bool(loaded)
+
+    stop = opt.stop
+    if stop is None:
+        import Chandra.Time
+        stop = Chandra.Time.DateTime(Chandra.Time.DateTime(opt.start).secs + 3600).date
+
+    runs = [('fetch.py --help', [FETCH, '--help'], opt.help_budget),
+            ('one hour fetch', [FETCH, '--start', opt.start, '--stop', stop,
+                                '--outfile', os.devnull] + colspecs, opt.fetch_budget)]
+    for name, cmd, budget in runs:
+        elapsed = min(time_command([opt.python] + cmd, env) for i in range(opt.repeat))
+        over = elapsed > budget
+        print '%-16s %7.3f sec (budget %.3f sec) %s' % (name, elapsed, budget,
+                                                         'OVER' if over else 'ok')
+        failed |= over
+
+    sys.exit(1 if failed else 0)
+
+def time_command(cmd, env):
+    """Return the wall clock time to run ``cmd``"""
+    t0 = time.time()
+    subprocess.check_call(cmd, env=env, stdout=open(os.devnull, 'w'),
+                          stderr=open(os.devnull, 'w'))
+    return time.time() - t0
+
+def get_options():
+    from optparse import OptionParser
+    parser = OptionParser(usage='startup.py [options] [col_spec1 ...]')
+    parser.set_defaults()
+    parser.add_option("--python",
+                      default=sys.executable,
+                      help="Python interpreter to run fetch.py (default = this one)",
+                      )
+    parser.add_option("--start",
+                      default='2008:081:12:00:00',
+                      help="Start date of the one hour fetch",
+                      )
+    parser.add_option("--stop",
+                      help="Stop date of the fetch (default = start + 1 hour)",
+                      )
+    parser.add_option("--help-budget",
+                      type='float',
+                      default=0.5,
+                      help="Time budget for fetch.py --help (sec)",
+                      )
+    parser.add_option("--fetch-budget",
+                      type='float',
+                      default=2.0,
+                      help="Time budget for the one hour fetch (sec)",
+                      )
+    parser.add_option("--repeat",
+                      type='int',
+                      default=3,
+                      help="Number of runs of each command (best time is used)",
+                      )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
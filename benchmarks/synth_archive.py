@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+Generate a synthetic telemetry archive for benchmarking.
+
+Creates <root>/data/telem_archive with the same layout as the real archive:
+YYYY/DOY/<table>.fits.gz day files with tstart, tstop and quality columns,
+tables/<table>.yml definitions and a db.sql3 observations table.  Column values
+are slowly varying random walks so the files compress and format like real
+telemetry.  Each day file has a chance of containing a data gap and each table
+has a chance of missing a day entirely.
+
+Example::
+
+  python benchmarks/synth_archive.py --root /tmp/bench_ska --start 2008:001 --days 35
+"""
+import os
+import gzip
+import shutil
+import sqlite3
+import numpy
+
+# Table name: (row interval (sec), float columns, int columns, string columns)
+TABLES = {'ephin2eng': (32.8,
+                        ['tephin', 'tephin2', 'ephin_hv', 'ephin_i1', 'ephin_i2',
+                         'ephin_t1', 'ephin_t2', 'ephin_t3', 'ephin_v1', 'ephin_v2'],
+                        ['hkp27v', 'hkn6v', 'hkp5v', 'ephin_cnt1', 'ephin_cnt2'],
+                        ['ephin_state']),
+          'acis2eng': (16.4,
+                       ['1pdeaat', '1pdeabt', '1deamzt', '1dpamzt', '1wrat', '1crat',
+                        '1crbt', '1dp28avo', '1dp28bvo', '1dahavo', '1dahbvo', '1de28avo'],
+                       ['1dehtron', '1depaon', '1stat1st'],
+                       ['acis_mode']),
+          'pcad8eng': (8.2,
+                       ['aoattqt1', 'aoattqt2', 'aoattqt3', 'aoattqt4',
+                        'aogyrct1', 'aogyrct2', 'aogyrct3', 'aogyrct4',
+                        'aorate1', 'aorate2', 'aorate3', 'aodithr2', 'aodithr3',
+                        'aoacrpt', 'aoacyan', 'aoaczan'],
+                       ['aopcadmd', 'aoacaseq', 'aonstars', 'aokalstr'],
+                       ['pcad_mode', 'aoacfct1']),
+          }
+
+STATES = numpy.array(['NPNT', 'NMAN', 'STBY', 'OK  ', 'WARN'])
+
+def main():
+    (opt, args) = get_options()
+    make_archive(opt.root, opt.start, opt.days, gap_prob=opt.gap_prob,
+                 missing_prob=opt.missing_prob, seed=opt.seed)
+
+def make_archive(root, start='2008:001', n_days=35, gap_prob=0.3, missing_prob=0.05,
+                 seed=1):
+    """Create a synthetic archive under ``root`` (used as $SKA) covering ``n_days``
+    days from ``start`` ('YYYY:DOY').  Return the telem_archive data directory."""
+    import Chandra.Time
+
+    data = os.path.join(root, 'data', 'telem_archive')
+    if os.path.exists(data):
+        shutil.rmtree(data)
+    os.makedirs(os.path.join(data, 'tables'))
+    rng = numpy.random.RandomState(seed)
+
+    tstart = Chandra.Time.DateTime(start).secs
+    days = []
+    for i in range(n_days + 1):
+        date = Chandra.Time.DateTime(tstart + i * 86400 + 1).date
+        days.append((int(date[0:4]), int(date[5:8]),
+                     Chandra.Time.DateTime(date[:8]).secs))
+
+    for table_name in sorted(TABLES):
+        dt, float_cols, int_cols, str_cols = TABLES[table_name]
+        write_table_def(data, table_name, float_cols + int_cols + str_cols)
+        state = {}
+        for i in range(n_days):
+            year, doy, day_tstart = days[i]
+            day_tstop = days[i + 1][2]
+            if rng.rand() < missing_prob:
+                continue
+            write_day_file(data, table_name, year, doy, day_tstart, day_tstop, rng,
+                           state, gap_prob)
+
+    write_observations(data, days[0][2], days[-1][2], rng)
+    return data
+
+def write_table_def(data, table_name, col_names):
+    with open(os.path.join(data, 'tables', table_name + '.yml'), 'w') as f:
+        f.write('columns:\n')
+        for col_name in ['time', 'quality'] + col_names:
+            f.write('  - name: %s\n' % col_name)
+        f.write('  - name: %s_spare\n    is_output: False\n' % table_name)
+
+def random_walk(rng, n, start, scale):
+    return numpy.round(start + numpy.cumsum(rng.randn(n) * scale), 2)
+
+def write_day_file(data, table_name, year, doy, day_tstart, day_tstop, rng, state,
+                   gap_prob):
+    """Write one day file of ``table_name`` with rows of the table interval that
+    start within the day and, with probability gap_prob, a gap of up to an hour"""
+    import pyfits
+
+    dt, float_cols, int_cols, str_cols = TABLES[table_name]
+    n_rows = int((day_tstop - day_tstart) / dt)
+    row_tstart = day_tstart + rng.rand() * dt + numpy.arange(n_rows) * dt
+    row_tstart = row_tstart[row_tstart < day_tstop]
+    if rng.rand() < gap_prob:
+        gap_start = day_tstart + rng.rand() * (day_tstop - day_tstart)
+        gap_len = rng.rand() * 3600
+        row_tstart = row_tstart[(row_tstart < gap_start) | (row_tstart > gap_start + gap_len)]
+    n = len(row_tstart)
+
+    cols = [pyfits.Column(name='tstart', format='D', array=row_tstart),
+            pyfits.Column(name='tstop', format='D', array=row_tstart + dt),
+            pyfits.Column(name='quality', format='J', array=(rng.rand(n) < 0.005).astype(int)),
+            pyfits.Column(name=table_name + '_spare', format='E', array=numpy.zeros(n))]
+    for col_name in float_cols:
+        vals = random_walk(rng, n, state.get(col_name, rng.rand() * 100), 0.05)
+        state[col_name] = vals[-1]
+        cols.append(pyfits.Column(name=col_name, format='E', array=vals))
+    for col_name in int_cols:
+        vals = numpy.cumsum(rng.rand(n) < 0.001) + state.get(col_name, rng.randint(0, 10))
+        state[col_name] = vals[-1]
+        cols.append(pyfits.Column(name=col_name, format='J', array=vals))
+    for col_name in str_cols:
+        i_state = numpy.cumsum(rng.rand(n) < 0.002) + state.get(col_name, 0)
+        state[col_name] = i_state[-1]
+        cols.append(pyfits.Column(name=col_name, format='4A',
+                                  array=STATES[i_state % len(STATES)]))
+
+    outdir = os.path.join(data, '%04d' % year, '%03d' % doy)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    filename = os.path.join(outdir, table_name + '.fits')
+    pyfits.HDUList([pyfits.PrimaryHDU(), pyfits.new_table(cols)]).writeto(filename)
+    fin = open(filename, 'rb')
+    fout = gzip.open(filename + '.gz', 'wb')
+    shutil.copyfileobj(fin, fout)
+    fout.close()
+    fin.close()
+    os.unlink(filename)
+
+def write_observations(data, tstart, tstop, rng):
+    """Write db.sql3 with an observations table of back to back observations of
+    1 to 30 ksec, numbered from obsid 10000"""
+    conn = sqlite3.connect(os.path.join(data, 'db.sql3'))
+    conn.execute('CREATE TABLE observations '
+                 '(obsid int, kalman_tstart float, kalman_tstop float)')
+    obsid = 10000
+    obs_tstart = tstart + 600
+    while True:
+        obs_tstop = obs_tstart + 1000 + rng.rand() * 29000
+        if obs_tstop > tstop:
+            break
+        conn.execute('INSERT INTO observations VALUES (?, ?, ?)', (obsid, obs_tstart, obs_tstop))
+        obsid += 1
+        obs_tstart = obs_tstop + 600
+    conn.commit()
+    conn.close()
+
+def get_options():
+    from optparse import OptionParser
+    parser = OptionParser(usage='synth_archive.py [options]')
+    parser.set_defaults()
+    parser.add_option("--root",
+                      default='bench_ska',
+                      help="Root of the synthetic archive (used as $SKA)",
+                      )
+    parser.add_option("--start",
+                      default='2008:001',
+                      help="First day of the archive (YYYY:DOY)",
+                      )
+    parser.add_option("--days",
+                      type='int',
+                      default=35,
+                      help="Number of days in the archive",
+                      )
+    parser.add_option("--gap-prob",
+                      type='float',
+                      default=0.3,
+                      help="Probability of a data gap in each day file",
+                      )
+    parser.add_option("--missing-prob",
+                      type='float',
+                      default=0.05,
+                      help="Probability of each day file being missing",
+                      )
+    parser.add_option("--seed",
+                      type='int',
+                      default=1,
+                      help="Random number seed",
+                      )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,15 @@ setup(name='Ska.TelemArchive',
       py_modules = ['Ska.TelemArchive.fetch',
                     'Ska.TelemArchive.fetch_client',
                     'Ska.TelemArchive.fetch_server',
-                    'Ska.TelemArchive.data_table'],
+                    'Ska.TelemArchive.data_table',
+                    'Ska.TelemArchive.column_store',
+                    'Ska.TelemArchive.archive_index',
+                    'Ska.TelemArchive.output',
+                    'Ska.TelemArchive.time_convert',
+                    'Ska.TelemArchive.table_catalog',
+                    'Ska.TelemArchive.fetch_stats',
+                    'Ska.TelemArchive.fetch_protocol',
+                    'Ska.TelemArchive.shm_cache'],
       version=__version__,
       zip_safe=False,
       packages=['Ska', 'Ska.TelemArchive'],